@@ -0,0 +1,152 @@
+"""
+post 的冷热分层。
+
+所有 post 都在一张 post 表里,历史越长,索引越大,可几乎所有的读都只看最近几天。
+db_archive_posts.py (archive_posts) 把早于 ARCHIVE_HORIZON_DAYS 天的 post 按月份搬到归档表
+post_archive_YYYYMM 里(列和 post 一样,id 不变),同时删掉它们在 timeline 表里的行。
+
+读的时候:
+- 首页时间线和个人主页默认只查 post / timeline 这两张热表;
+- 翻页翻过了热数据,分页(app/pagination.py)会按月份一张一张地接着查归档表,
+  凑够一页就停下,见 timeline_tiers / profile_tiers;
+- 搜索结果里已经归档的 post 用 find_posts 按 id 取出来;
+- reconcile_counters 的 post_count 把归档表也算进去。
+
+每个归档表映射成一个 ArchivedPost<YYYYMM> 类,有 id、body、timestamp 和 author,模板不用区分。
+已有哪些归档表在进程里缓存 ARCHIVE_TABLES_TTL 秒。
+"""
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, Table, inspect
+from app import app, db
+from .models import User, Post, followers, timeline, with_authors
+
+PREFIX = 'post_archive_'
+
+metadata = MetaData()
+_classes = {}
+_months = (0, None)
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(when):
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+
+
+def archive_class(key):
+    """
+    某个月(YYYYMM)的归档表对应的映射类,第一次用到的时候定义
+    """
+    if key not in _classes:
+        name = PREFIX + key
+        # 不放进 db.metadata,免得 db.create_all / db.drop_all 把进程里见过的归档表都建出来或者删掉
+        table = Table(name, metadata,
+                      db.Column('id', db.Integer, primary_key=True),
+                      db.Column('body', db.String(140)),
+                      db.Column('timestamp', db.DateTime),
+                      db.Column('user_id', db.Integer, db.ForeignKey(User.__table__.c.id)),
+                      db.Column('fanned_out', db.Boolean),
+                      db.Index('ix_{}_user_timestamp'.format(name), 'user_id', 'timestamp', 'id'),
+                      db.Index('ix_{}_timestamp'.format(name), 'timestamp', 'id'))
+        _classes[key] = type('ArchivedPost' + key, (db.Model,), {
+            '__table__': table,
+            'author': db.relationship(User),
+            '__repr__': lambda self: '<ArchivedPost {}>'.format(self.body),
+        })
+    return _classes[key]
+
+
+def months():
+    """
+    已有的归档月份,从新到旧
+    """
+    global _months
+    now = time.time()
+    if _months[1] is None or now - _months[0] > app.config['ARCHIVE_TABLES_TTL']:
+        names = inspect(db.engine).get_table_names()
+        _months = (now, sorted((name[len(PREFIX):] for name in names if name.startswith(PREFIX)), reverse=True))
+    return _months[1]
+
+
+def refresh():
+    global _months
+    _months = (0, None)
+
+
+def archive_tables():
+    return [archive_class(key).__table__ for key in months()]
+
+
+def tiers(branch):
+    """
+    :param branch: branch(cls) 返回某个归档类上未排序的查询
+    :return: app.pagination.paginate 的 archives 参数
+    """
+    if not app.config['POST_ARCHIVE']:
+        return []
+    result = []
+    for key in months():
+        cls = archive_class(key)
+        start = datetime.strptime(key, '%Y%m')
+        result.append(([(branch(cls), cls.timestamp, cls.id)], start, next_month(start)))
+    return result
+
+
+def timeline_tiers(user, loading=None):
+    # 归档的 post 没有 timeline 行,读的时候和 followers 连接
+    return tiers(lambda cls: with_authors(cls.query.join(followers, followers.c.followed_id == cls.user_id)
+                                                   .filter(followers.c.follower_id == user.id),
+                                          loading, entity=cls))
+
+
+def profile_tiers(user):
+    return tiers(lambda cls: cls.query.filter(cls.user_id == user.id))
+
+
+def find_posts(ids):
+    """
+    按 id 在归档表里找 post,返回 {id: post}
+    """
+    found = {}
+    for key in months():
+        if len(found) == len(ids):
+            break
+        cls = archive_class(key)
+        for post in with_authors(cls.query.filter(cls.id.in_([i for i in ids if i not in found])), entity=cls):
+            found[post.id] = post
+    return found
+
+
+def archive_posts(horizon_days=None, batch_size=1000):
+    """
+    把早于 horizon_days 天(按整月对齐)的 post 搬到归档表,每批一个事务。返回搬走的 post 数
+    """
+    horizon_days = horizon_days or app.config['ARCHIVE_HORIZON_DAYS']
+    cutoff = month_start(datetime.utcnow() - timedelta(days=horizon_days))
+    posts = Post.__table__
+    moved = 0
+    while True:
+        oldest = db.session.query(Post.timestamp).filter(Post.timestamp < cutoff)\
+                                                 .order_by(Post.timestamp)\
+                                                 .first()
+        if oldest is None:
+            break
+        start = month_start(oldest[0])
+        table = archive_class(start.strftime('%Y%m')).__table__
+        table.create(db.session.connection(), checkfirst=True)
+        ids = [row[0] for row in db.session.query(Post.id)
+                                           .filter(Post.timestamp >= start, Post.timestamp < next_month(start))
+                                           .order_by(Post.id)
+                                           .limit(batch_size)]
+        columns = ['id', 'body', 'timestamp', 'user_id', 'fanned_out']
+        rows = db.session.query(*[posts.c[name] for name in columns]).filter(posts.c.id.in_(ids))
+        db.session.execute(table.insert().from_select(columns, rows.statement))
+        db.session.execute(timeline.delete().where(timeline.c.post_id.in_(ids)))
+        db.session.execute(posts.delete().where(posts.c.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+    refresh()
+    return moved
@@ -0,0 +1,70 @@
+"""
+头像 URL。
+
+邮箱的 MD5 在写入/修改邮箱的时候算好存在 User.email_hash 里(老数据用 db_backfill_avatars.py 补),
+URL 按 (digest, size) 缓存,渲染一页时间线不用再反复算哈希、拼字符串。
+
+AVATAR_LOCAL 打开以后头像改成由本站的 /avatar/<digest>/<size> 提供:第一次请求时从 Gravatar 取一份
+指定尺寸的图片存到 AVATAR_DIR,之后直接读本地文件,页面不再依赖 Gravatar 的延迟。
+取不到的时候重定向回 Gravatar。
+"""
+import os
+import re
+from functools import lru_cache
+from hashlib import md5
+from urllib.request import urlopen
+from app import app
+
+GRAVATAR_URL = 'http://www.gravatar.com/avatar/'
+
+_digest_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def email_digest(email):
+    # Gravatar 要求先去掉首尾空白并转成小写
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def gravatar_url(digest, size):
+    """
+    d=mm 决定什么样的图片占位符当用户没有 Gravatar 账户,mm 选项将会返回一个“神秘人”图片。
+    s=N 选项要求头像按照以像素为单位的给定尺寸缩放。
+    """
+    return GRAVATAR_URL + digest + '?d=mm&s=' + str(size)
+
+
+@lru_cache(maxsize=4096)
+def _avatar_url(digest, size, local):
+    if local:
+        return '/avatar/{}/{}'.format(digest, size)
+    return gravatar_url(digest, size)
+
+
+def avatar_url(digest, size):
+    return _avatar_url(digest, size, app.config['AVATAR_LOCAL'])
+
+
+def valid_request(digest, size):
+    return _digest_re.match(digest) is not None and 0 < size <= app.config['AVATAR_MAX_SIZE']
+
+
+def local_avatar(digest, size):
+    """
+    返回本地缓存的头像文件路径,本地没有就先从 Gravatar 取。取不到返回 None
+    """
+    path = os.path.join(app.config['AVATAR_DIR'], '{}_{}.jpg'.format(digest, size))
+    if os.path.exists(path):
+        return path
+    try:
+        data = urlopen(gravatar_url(digest, size), timeout=app.config['AVATAR_FETCH_TIMEOUT']).read()
+    except (IOError, ValueError):
+        app.logger.warning('failed to fetch avatar {} at size {}'.format(digest, size))
+        return None
+    if not os.path.isdir(app.config['AVATAR_DIR']):
+        os.makedirs(app.config['AVATAR_DIR'])
+    # 先写临时文件再改名,并发的请求不会读到写了一半的文件
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,242 @@
+"""
+进程内 LRU 缓存 + 可选的共享缓存。
+
+每个缓存有两层:
+local  进程内的 LRUCache,有容量上限和 TTL;
+shared 可选的跨进程缓存。这里用 shelve 文件做本地的替身,接口和 memcached 之类的一样是 get/set/delete,
+       换成真正的缓存服务只需要换掉这一层。
+
+缓存用 get_cache(name) 按配置取,比如 get_cache('FOLLOW_CACHE') 读 FOLLOW_CACHE_SIZE、
+FOLLOW_CACHE_TTL 和 FOLLOW_CACHE_SHARED。
+
+写操作要等事务提交以后才能更新缓存,否则回滚以后缓存里就是脏数据。on_commit 把回调挂在当前 session 上,
+提交后执行,回滚就丢掉。
+"""
+import shelve
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from app import app, db
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    线程安全的 LRU 缓存,每个条目可以有自己的过期时间
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _missing)
+            if item is not _missing:
+                expires, value = item
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ShelveCache(object):
+    """
+    基于 shelve 文件的共享缓存,多个进程打开同一个文件就能共享。
+    每次操作都重新打开文件并加文件锁,只适合开发和单机部署,生产环境应该换成缓存服务。
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _open(self):
+        lock_file = open(self.path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file, shelve.open(self.path)
+
+    def _close(self, lock_file, shelf):
+        shelf.close()
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def get(self, key, default=None):
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                expires, value = shelf.get(key, (None, _missing))
+                if value is _missing:
+                    return default
+                if expires is not None and expires <= time.time():
+                    del shelf[key]
+                    return default
+                return value
+            finally:
+                self._close(lock_file, shelf)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                shelf[key] = (time.time() + ttl if ttl else None, value)
+            finally:
+                self._close(lock_file, shelf)
+
+    def delete(self, key):
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                shelf.pop(key, None)
+            finally:
+                self._close(lock_file, shelf)
+
+    def clear(self):
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                shelf.clear()
+            finally:
+                self._close(lock_file, shelf)
+
+
+class TieredCache(object):
+    """
+    先查进程内的 LRU,没有再查共享缓存,都没有才调用 loader 去数据库加载
+    """
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _missing)
+        if value is _missing and self.shared is not None:
+            value = self.shared.get(key, _missing)
+            if value is not _missing:
+                self.local.set(key, value)
+        return default if value is _missing else value
+
+    def get_or_set(self, key, loader):
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    @property
+    def hits(self):
+        return self.local.hits
+
+    @property
+    def misses(self):
+        return self.local.misses
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name):
+    """
+    按配置 <name>_SIZE / <name>_TTL / <name>_SHARED 创建(并缓存)一个 TieredCache
+    """
+    cache = _caches.get(name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                ttl = app.config.get(name + '_TTL')
+                shared_path = app.config.get(name + '_SHARED')
+                cache = TieredCache(LRUCache(app.config.get(name + '_SIZE', 1024), ttl),
+                                    ShelveCache(shared_path, ttl) if shared_path else None)
+                _caches[name] = cache
+    return cache
+
+
+def cache_stats():
+    """
+    各个缓存的命中率,用来调整容量和 TTL
+    """
+    stats = {}
+    for name, cache in _caches.items():
+        lookups = cache.hits + cache.misses
+        stats[name] = {'hits': cache.hits,
+                       'misses': cache.misses,
+                       'hit_rate': float(cache.hits) / lookups if lookups else 0.0,
+                       'entries': len(cache.local)}
+    return stats
+
+
+def clear_caches():
+    for cache in list(_caches.values()):
+        cache.clear()
+
+
+def on_commit(session, callback):
+    """
+    session 提交以后执行 callback, 回滚的话就丢掉
+    """
+    session.info.setdefault('on_commit', []).append(callback)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _run_on_commit(session):
+    for callback in session.info.pop('on_commit', ()):
+        callback()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_on_commit(session):
+    session.info.pop('on_commit', None)
@@ -0,0 +1,96 @@
+"""
+条件 GET 和响应压缩。
+
+首页和个人主页以前每次都完整地查 post、渲染模板、把整页发回去,哪怕和浏览器上次拿到的一模一样。
+现在先用几条很便宜的查询(索引上倒着读一行,或者已经加载了的 User 字段)算出页面的状态:
+
+首页     看的人、他的资料版本和关注数,时间线里最新一条 post 的 (timestamp, id)
+个人主页 主人的资料版本、last_seen、三个计数、最新一条 post,以及看的人和他是否已关注主人
+
+状态的哈希作为 ETag,最新的时间作为 Last-Modified。浏览器带着 If-None-Match / If-Modified-Since
+回来、状态又没变的时候,在查 post 和渲染模板之前就直接返回 304。
+页面是按登录用户生成的,所以是 Cache-Control: private, no-cache (每次都要回来验证)。
+有 flash 消息要显示的时候总是完整渲染。
+
+别的作者改了昵称不会改变首页的 ETag,要等有新 post 或者关注关系变了以后才会看到。
+
+真正发出去的 HTML/JSON 按 Accept-Encoding 用 gzip 压缩,太小的响应不压。
+"""
+import gzip
+from collections import namedtuple
+from hashlib import md5
+from flask import request, session
+from werkzeug.http import is_resource_modified
+from app import app
+from .models import Post, timeline_backend
+from .pagination import newest
+
+Validators = namedtuple('Validators', ['etag', 'last_modified'])
+
+
+def validators(state, last_modified=None):
+    """
+    :param state: 决定页面内容的值组成的元组,repr 以后取哈希
+    """
+    etag = md5(repr(state).encode('utf-8')).hexdigest()
+    return Validators(etag, last_modified)
+
+
+def timeline_validators(user):
+    latest = newest(timeline_backend().branches(user))
+    state = ('index', user.id, user.profile_version, user.followed_count, latest)
+    return validators(state, latest[0] if latest else None)
+
+
+def profile_validators(user, viewer):
+    latest = newest([(user.posts, Post.timestamp, Post.id)])
+    state = ('user', user.id, user.profile_version, user.last_seen,
+             user.follower_count, user.followed_count, user.post_count, latest,
+             viewer.id, viewer.profile_version, viewer.is_following(user))
+    times = [t for t in (user.last_seen, latest[0] if latest else None) if t is not None]
+    return validators(state, max(times) if times else None)
+
+
+def is_fresh(v):
+    """
+    浏览器手里的那份是不是还是最新的
+    """
+    if not app.config['CONDITIONAL_GET'] or request.method not in ('GET', 'HEAD'):
+        return False
+    if session.get('_flashes'):
+        return False
+    return not is_resource_modified(request.environ, etag=v.etag, last_modified=v.last_modified)
+
+
+def with_validators(response, v):
+    if not app.config['CONDITIONAL_GET']:
+        return response
+    # 压缩以后字节不一样,所以用弱 ETag
+    response.set_etag(v.etag, weak=True)
+    if v.last_modified is not None:
+        response.last_modified = v.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(v):
+    return with_validators(app.response_class(status=304), v)
+
+
+@app.after_request
+def compress(response):
+    if not app.config['COMPRESS'] or response.status_code != 200 or response.direct_passthrough \
+            or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, app.config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,79 @@
+"""
+User 上冗余计数字段(follower_count / followed_count / post_count)的维护。
+
+关注数在 User.follow/unfollow 里维护; post 数在这里的 after_flush 钩子里维护,
+不管 post 是从哪里写进来的,都和 post 在同一个事务里更新。
+
+计数万一和真实数据不一致了(直接改库、老数据、bug),用 reconcile_counters 分批重算,
+对应的命令行是 db_reconcile_counters.py。
+"""
+from collections import Counter
+from sqlalchemy import event, func, or_
+from app import db
+from .archive import archive_tables
+from .models import User, Post, followers
+
+
+@event.listens_for(db.session, 'after_flush')
+def count_posts(session, flush_context):
+    delta = Counter()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            delta[obj.user_id] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            delta[obj.user_id] -= 1
+    users = User.__table__
+    for user_id, n in delta.items():
+        if user_id is not None and n:
+            session.execute(users.update()
+                                 .where(users.c.id == user_id)
+                                 .values(post_count=users.c.post_count + n))
+            author = session.identity_map.get(session.identity_key(User, user_id))
+            if author is not None:
+                session.expire(author, ['post_count'])
+
+
+def reconcile_counters(batch_size=500):
+    """
+    按用户 id 分批重算计数,每批一条 UPDATE (只改和真实值不一样的行),一批一个事务。
+    返回修复的用户数。
+    """
+    users = User.__table__
+    follower_count = db.session.query(func.count(followers.c.follower_id))\
+                               .filter(followers.c.followed_id == users.c.id)\
+                               .label('follower_count')
+    followed_count = db.session.query(func.count(followers.c.followed_id))\
+                               .filter(followers.c.follower_id == users.c.id)\
+                               .label('followed_count')
+    # 归档了的 post 也算数,见 app/archive.py
+    post_count = sum((db.session.query(func.count(table.c.id))
+                                .filter(table.c.user_id == users.c.id)
+                                .scalar_subquery()
+                      for table in archive_tables()),
+                     db.session.query(func.count(Post.id))
+                               .filter(Post.user_id == users.c.id)
+                               .scalar_subquery()).label('post_count')
+    repaired, last_id = 0, 0
+    while True:
+        ids = [row[0] for row in db.session.query(User.id)
+                                           .filter(User.id > last_id)
+                                           .order_by(User.id)
+                                           .limit(batch_size)]
+        if not ids:
+            break
+        result = db.session.execute(users.update()
+                                         .where(users.c.id.in_(ids))
+                                         .where(or_(users.c.follower_count != follower_count,
+                                                    users.c.followed_count != followed_count,
+                                                    users.c.post_count != post_count,
+                                                    users.c.follower_count.is_(None),
+                                                    users.c.followed_count.is_(None),
+                                                    users.c.post_count.is_(None)))
+                                         .values(follower_count=follower_count,
+                                                 followed_count=followed_count,
+                                                 post_count=post_count))
+        db.session.commit()
+        repaired += result.rowcount
+        last_id = ids[-1]
+    return repaired
@@ -0,0 +1,101 @@
+"""
+数据库引擎的配置。
+
+init_app 在创建 db 之前调用:
+- 按 DATABASE_ENV (环境变量 MICROBLOG_ENV) 从 DATABASE_ENVIRONMENTS 里取连接池参数,
+  生成 Flask-SQLAlchemy 的 SQLALCHEMY_ENGINE_OPTIONS;
+- 如果是 SQLite,每个新连接建立的时候执行 SQLITE_PRAGMAS 里的 PRAGMA。
+  journal_mode=WAL 让读不再被写阻塞,synchronous=NORMAL 在 WAL 下是安全的,
+  busy_timeout 让写锁冲突时等一会儿而不是直接报 database is locked。
+
+serve.py 的 worker 进程在 fork 以后调用 after_fork,丢掉从父进程继承来的连接池,每个进程用自己的连接。
+
+配置了 SQLALCHEMY_READ_URI (只读副本)的时候,被 @read_only 装饰的视图(时间线、个人主页)
+里的只读查询走 read_session(),连的是副本,读的吞吐量可以和写分开扩展。没有配置副本就还是 db.session。
+"""
+import sqlite3
+from functools import wraps
+from flask import g, has_app_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(uri, settings):
+    options = dict(settings)
+    if uri.startswith('sqlite'):
+        # 文件型 SQLite 在老版本的 SQLAlchemy 里默认不用连接池,这里显式地用 QueuePool,
+        # 连接会在线程之间复用,所以要关掉 sqlite3 的同线程检查
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('connect_args', {'check_same_thread': False})
+    return options
+
+
+def init_app(app):
+    settings = app.config['DATABASE_ENVIRONMENTS'][app.config['DATABASE_ENV']]
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config['SQLALCHEMY_DATABASE_URI'], settings))
+    pragmas = app.config['SQLITE_PRAGMAS']
+
+    @event.listens_for(Engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+    @app.teardown_appcontext
+    def remove_read_session(exception=None):
+        if _read_session is not None:
+            _read_session.remove()
+
+
+_read_session = None
+
+
+def read_session():
+    """
+    只读查询用的 session。在 @read_only 的视图里并且配置了 SQLALCHEMY_READ_URI 时连只读副本,
+    否则就是 db.session
+    """
+    global _read_session
+    from app import app, db
+    uri = app.config.get('SQLALCHEMY_READ_URI')
+    if not uri or not has_app_context() or not g.get('read_only'):
+        return db.session()
+    if _read_session is None:
+        settings = app.config['DATABASE_ENVIRONMENTS'][app.config['DATABASE_ENV']]
+        engine = create_engine(uri, **engine_options(uri, settings))
+        _read_session = scoped_session(sessionmaker(bind=engine))
+    return _read_session()
+
+
+def read_query(model):
+    return model.query.with_session(read_session())
+
+
+def read_only(f):
+    """
+    标记一个只读的视图,里面通过 read_session()/read_query() 发出的查询可以走只读副本
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+def after_fork(app, db):
+    """
+    fork 出来的子进程里调用。SQLite 的连接不能跨进程共享,
+    dispose(close=False) 换一个新的连接池,又不会关掉父进程还在用的连接
+    """
+    global _read_session
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if _read_session is not None:
+        _read_session.bind.dispose(close=False)
+        _read_session = None
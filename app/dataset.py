@@ -0,0 +1,173 @@
+"""
+可移植的数据导出/导入。
+
+复制 app.db 只能在同一种数据库之间用,迁移脚本(db_create.py/db_upgrade.py)又只管表结构。
+这里把 user、post、followers 三张表导出成一个目录里的三个文件,可以导入到任何一个用 db_create.py 建好的空库:
+
+    json  每行一个 JSON 对象(newline-delimited JSON)
+    csv   第一行是列名,NULL 写成 \\N
+
+导出用 yield_per 流式地读,一批一批地写文件;导入一批一批地 executemany。
+不管有多少行,内存里都只有一批,对应的命令行是 db_export.py 和 db_import.py。
+
+导入在一个事务里完成:外键检查推迟到提交的时候,导入之前先删掉这几张表的索引,全部插完以后再一次建回来,
+比一边插一边维护索引快得多。唯一索引也是这时候才建,数据里有重复的话会在这一步报错,整个导入回滚。
+timeline 表和搜索索引是派生数据,导入以后重建。归档表(app/archive.py)里的 post 导出到 post 文件里。
+"""
+import csv
+import json
+import os
+from datetime import datetime
+from sqlalchemy import text
+from app import db
+from .archive import archive_tables
+from .models import User, Post, followers
+
+TABLES = [User.__table__, Post.__table__, followers]
+FORMATS = ('json', 'csv')
+NULL = '\\N'
+
+
+def _path(directory, table, fmt):
+    return os.path.join(directory, '{}.{}'.format(table.name, 'jsonl' if fmt == 'json' else 'csv'))
+
+
+def _to_text(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _parse_datetime(value):
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+    return datetime.strptime(value, fmt)
+
+
+def _converters(table, fmt):
+    """
+    每一列从文件里读出来的值怎么转回数据库的类型。JSON 里数字本来就是数字,CSV 里全是字符串
+    """
+    converters = {}
+    for column in table.columns:
+        python_type = column.type.python_type
+        if python_type is datetime:
+            converters[column.name] = _parse_datetime
+        elif python_type is int and fmt == 'csv':
+            converters[column.name] = int
+        elif python_type is bool and fmt == 'csv':
+            converters[column.name] = lambda value: value == 'True'
+    return converters
+
+
+def iter_rows(table, batch_size):
+    """
+    按主键顺序流式读一张表,每次产出一批行(元组)
+    """
+    columns = list(table.columns)
+    order = list(table.primary_key.columns) or columns
+    query = db.session.query(*columns).order_by(*order).yield_per(batch_size)
+    batch = []
+    for row in query:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_table(tables, path, fmt, batch_size):
+    """
+    把几张列相同的表写进同一个文件
+    """
+    names = [column.name for column in tables[0].columns]
+    count = 0
+    with open(path, 'w', newline='' if fmt == 'csv' else None, encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(names)
+        for batch in (batch for table in tables for batch in iter_rows(table, batch_size)):
+            if writer is not None:
+                writer.writerows([NULL if value is None else _to_text(value) for value in row] for row in batch)
+            else:
+                f.write(''.join(json.dumps(dict(zip(names, map(_to_text, row)))) + '\n' for row in batch))
+            count += len(batch)
+    return count
+
+
+def export_data(directory, fmt='json', batch_size=1000):
+    """
+    导出到 directory,返回 {表名: 行数}
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format: {}'.format(fmt))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    counts = {}
+    for table in TABLES:
+        tables = [table]
+        if table is Post.__table__:
+            # 归档表里的 post 也导出到 post 文件里,导入以后都在 post 表,需要的话再归档一次
+            tables.extend(archive_tables())
+        counts[table.name] = export_table(tables, _path(directory, table, fmt), fmt, batch_size)
+    db.session.rollback()
+    return counts
+
+
+def read_rows(table, path, fmt, batch_size):
+    """
+    流式读一个导出文件,每次产出一批 dict
+    """
+    converters = _converters(table, fmt)
+    batch = []
+    with open(path, newline='' if fmt == 'csv' else None, encoding='utf-8') as f:
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            names = next(reader)
+            rows = (dict((name, None if value == NULL else value) for name, value in zip(names, values))
+                    for values in reader)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            for name, convert in converters.items():
+                if row.get(name) is not None:
+                    row[name] = convert(row[name])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _defer_constraints(connection):
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        connection.execute(text('PRAGMA defer_foreign_keys = ON'))
+    elif dialect == 'postgresql':
+        connection.execute(text('SET CONSTRAINTS ALL DEFERRED'))
+
+
+def import_data(directory, fmt='json', batch_size=1000):
+    """
+    从 directory 导入到空的数据库,返回 {表名: 行数}
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format: {}'.format(fmt))
+    if db.session.query(User.id).first() is not None:
+        raise ValueError('The database is not empty')
+    db.session.rollback()
+    counts = {}
+    with db.engine.begin() as connection:
+        _defer_constraints(connection)
+        indexes = [index for table in TABLES for index in table.indexes]
+        for index in indexes:
+            index.drop(connection)
+        for table in TABLES:
+            counts[table.name] = 0
+            for batch in read_rows(table, _path(directory, table, fmt), fmt, batch_size):
+                connection.execute(table.insert(), batch)
+                counts[table.name] += len(batch)
+        for index in indexes:
+            index.create(connection)
+    return counts
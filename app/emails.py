@@ -0,0 +1,37 @@
+"""
+邮件。发送走后台任务队列(见 app/jobs.py),请求里只是把任务放进队列。
+Flask-Mail 在第一次发邮件的时候才导入和初始化,见 app/extensions.py
+"""
+from flask import render_template
+from app import app
+from .extensions import LazyExtension
+from .jobs import job
+from .models import User
+
+mail = LazyExtension(app, 'flask_mail', 'Mail')
+
+
+@job
+def send_email(subject, sender, recipients, text_body, html_body):
+    from flask_mail import Message
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.body = text_body
+    msg.html = html_body
+    mail.send(msg)
+
+
+@job
+def follower_notification(followed_id, follower_id, profile_url):
+    """
+    通知 followed 有了一个新粉丝。在 worker 里执行,模板的渲染也不占用请求的时间。
+    worker 里没有请求上下文,粉丝主页的链接由放任务的视图生成好传进来
+    """
+    followed, follower = User.query.get(followed_id), User.query.get(follower_id)
+    if followed is None or follower is None:
+        return
+    send_email('[microblog] {} is now following you!'.format(follower.nickname),
+               app.config['ADMINS'][0],
+               [followed.email],
+               render_template('follower_email.txt', user=followed, follower=follower, profile_url=profile_url),
+               render_template('follower_email.html', user=followed, follower=follower,
+                               profile_url=profile_url))
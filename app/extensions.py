@@ -0,0 +1,81 @@
+"""
+延迟初始化的 Flask 扩展。
+
+Flask-OpenID(连带整个 python-openid)和 Flask-Mail 只有登录和发邮件的时候才用得到,
+可每个进程(web worker、worker.py、db_*.py 脚本、测试)一 import app 就要导入、初始化它们。
+这里的包装对象先只记下怎么创建扩展,第一次用到的时候才导入模块、创建真正的扩展对象,
+之后的属性访问都转发给它。
+"""
+import threading
+from functools import wraps
+from importlib import import_module
+from flask import request
+
+
+class LazyExtension(object):
+    """
+    LazyExtension(app, 'flask_mail', 'Mail') 第一次访问属性的时候相当于执行 flask_mail.Mail(app)
+    """
+    def __init__(self, app, module, name, *args, **kwargs):
+        self.app = app
+        self._factory = (module, name, args, kwargs)
+        self._extension = None
+        self._lock = threading.Lock()
+
+    def _create(self, extension):
+        """
+        扩展对象刚创建出来的时候调用,子类在这里补上之前记下的设置
+        """
+
+    def _get(self):
+        if self._extension is None:
+            with self._lock:
+                if self._extension is None:
+                    module, name, args, kwargs = self._factory
+                    extension = getattr(import_module(module), name)(self.app, *args, **kwargs)
+                    self._create(extension)
+                    self._extension = extension
+        return self._extension
+
+    @property
+    def loaded(self):
+        return self._extension is not None
+
+    def __getattr__(self, name):
+        # 下划线开头的多半是 copy、pytest 之类在探测对象,不值得为它们导入扩展
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+
+class LazyOpenID(LazyExtension):
+    """
+    代替 flask_openid.OpenID(app, fs_store_path)。
+    after_login / loginhandler 是在 import 的时候用的装饰器,先记下来;
+    只是打开登录页面的请求不需要 OpenID,提交了表单或者 OpenID 提供商跳回来的时候才真正创建
+    """
+    def __init__(self, app, fs_store_path=None):
+        LazyExtension.__init__(self, app, 'flask_openid', 'OpenID', fs_store_path)
+        self._after_login = None
+
+    def _create(self, extension):
+        if self._after_login is not None:
+            extension.after_login(self._after_login)
+
+    def after_login(self, f):
+        self._after_login = f
+        if self.loaded:
+            self._extension.after_login(f)
+        return f
+
+    def loginhandler(self, f):
+        handlers = []
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.args.get('openid_complete') != 'yes':
+                return f(*args, **kwargs)
+            if not handlers:
+                handlers.append(self._get().loginhandler(f))
+            return handlers[0](*args, **kwargs)
+        return decorated
@@ -0,0 +1,170 @@
+"""
+批量关注/取消关注。
+
+User.follow() 一次只处理一个人,每次往 followers 表插一行再改计数。导入一份社交关系,
+或者新用户一下关注 500 个推荐账号,就是上千次来回。这里按 FOLLOW_BATCH_SIZE 分批,每批:
+
+1. 一条查询从这批 id 里挑出真实存在、而且还没关注的用户
+   (NOT EXISTS 走 followers 上 (follower_id, followed_id) 的唯一索引);
+2. 一条 executemany 插入 followers;
+3. 一条 UPDATE 给这些人的 follower_count 加一。
+
+自己的 followed_count 在最后一次加上总数,时间线在最后用一条 INSERT ... SELECT 补上这些人最近的 post,
+关注缓存和推荐用的关注图(app/recommend.py)在提交以后更新。
+和 follow() 一样不提交,由调用的人 commit。
+
+POST /follow/import 用 parse_import 解析上传的关注列表,见 app/views.py。
+"""
+import csv
+import io
+import time
+from sqlalchemy import and_, exists
+from app import app, db
+from .cache import get_cache, on_commit
+from .models import User, followers, timeline_backend, update_followed_count, update_follower_counts
+from .recommend import recommender
+
+
+class BulkResult(object):
+    def __init__(self):
+        self.changed = []
+        self.batches = []
+
+    def add_batch(self, requested, changed, seconds):
+        self.changed.extend(changed)
+        self.batches.append({'requested': requested, 'changed': len(changed), 'seconds': seconds})
+
+    def to_dict(self):
+        return {'changed': len(self.changed), 'batches': self.batches}
+
+
+def _ids(users):
+    """
+    User 对象或者 id 都可以,去掉重复并保持顺序
+    """
+    seen, ids = set(), []
+    for user in users:
+        user_id = getattr(user, 'id', user)
+        if user_id is not None and user_id not in seen:
+            seen.add(user_id)
+            ids.append(user_id)
+    return ids
+
+
+def _chunks(ids, size):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _already_following(user):
+    return exists().where(and_(followers.c.follower_id == user.id,
+                               followers.c.followed_id == User.id))
+
+
+def _cache_follows(session, user, ids, following):
+    cache = get_cache('FOLLOW_CACHE')
+    keys = ['following:{}:{}'.format(user.id, user_id) for user_id in ids]
+
+    def update_cache():
+        for key in keys:
+            cache.set(key, following)
+    on_commit(session, update_cache)
+    # 内存里的关注图也在提交以后更新,见 app/recommend.py
+    follower_id = user.id
+    on_commit(session, lambda: recommender.changed(follower_id, ids, following))
+
+
+def follow_many(user, users, batch_size=None):
+    """
+    关注 users 里所有还没关注的人,返回 BulkResult,changed 是新关注的 id
+    """
+    session = db.session
+    batch_size = batch_size or app.config['FOLLOW_BATCH_SIZE']
+    result = BulkResult()
+    for chunk in _chunks(_ids(users), batch_size):
+        start = time.time()
+        new_ids = [row[0] for row in session.query(User.id)
+                                            .filter(User.id.in_(chunk))
+                                            .filter(~_already_following(user))]
+        if new_ids:
+            session.execute(followers.insert(),
+                            [{'follower_id': user.id, 'followed_id': user_id} for user_id in new_ids])
+            update_follower_counts(session, new_ids, 1)
+        result.add_batch(len(chunk), new_ids, time.time() - start)
+    if result.changed:
+        update_followed_count(session, user, len(result.changed))
+        timeline_backend().follow_many(user, result.changed)
+        _cache_follows(session, user, result.changed, True)
+    return result
+
+
+def unfollow_many(user, users, batch_size=None):
+    """
+    取消关注 users 里已经关注的人,返回 BulkResult,changed 是取消关注的 id
+    """
+    session = db.session
+    batch_size = batch_size or app.config['FOLLOW_BATCH_SIZE']
+    result = BulkResult()
+    for chunk in _chunks(_ids(users), batch_size):
+        start = time.time()
+        old_ids = [row[0] for row in session.query(followers.c.followed_id)
+                                            .filter(followers.c.follower_id == user.id)
+                                            .filter(followers.c.followed_id.in_(chunk))]
+        if old_ids:
+            session.execute(followers.delete()
+                                     .where(followers.c.follower_id == user.id)
+                                     .where(followers.c.followed_id.in_(old_ids)))
+            update_follower_counts(session, old_ids, -1)
+        result.add_batch(len(chunk), old_ids, time.time() - start)
+    if result.changed:
+        update_followed_count(session, user, -len(result.changed))
+        timeline_backend().unfollow_many(user, result.changed)
+        _cache_follows(session, user, result.changed, False)
+    return result
+
+
+def resolve_nicknames(nicknames, batch_size=None):
+    """
+    把昵称分批换成 id,找不到的昵称跳过。返回 (ids, 找不到的昵称)
+    """
+    batch_size = batch_size or app.config['FOLLOW_BATCH_SIZE']
+    nicknames = _ids(name.strip() for name in nicknames if name and name.strip())
+    found = {}
+    for chunk in _chunks(nicknames, batch_size):
+        for user_id, nickname in db.session.query(User.id, User.nickname).filter(User.nickname.in_(chunk)):
+            found[nickname] = user_id
+    return [found[name] for name in nicknames if name in found], [name for name in nicknames if name not in found]
+
+
+def parse_import(request):
+    """
+    解析导入的关注列表,返回 (要关注的昵称, 要取消关注的昵称)。
+    application/json  ["alice", "bob"] 或者 {"follow": [...], "unfollow": [...]}
+    text/csv          每行 "昵称" 或者 "昵称,follow|unfollow"
+    只接受这两种 Content-Type,跨站的表单提交发不出来。格式不对抛 ValueError
+    """
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if isinstance(data, list):
+            data = {'follow': data}
+        if not isinstance(data, dict):
+            raise ValueError('expected a list of nicknames or {"follow": [...], "unfollow": [...]}')
+        lists = data.get('follow', []), data.get('unfollow', [])
+        if not all(isinstance(names, list) and all(isinstance(name, str) for name in names)
+                   for names in lists):
+            raise ValueError('nicknames must be lists of strings')
+        return lists
+    if request.mimetype == 'text/csv':
+        to_follow, to_unfollow = [], []
+        for row in csv.reader(io.StringIO(request.get_data(as_text=True))):
+            if not row or not row[0].strip():
+                continue
+            action = row[1].strip().lower() if len(row) > 1 else 'follow'
+            if action == 'follow':
+                to_follow.append(row[0])
+            elif action == 'unfollow':
+                to_unfollow.append(row[0])
+            else:
+                raise ValueError('unknown action {!r} for {}'.format(action, row[0]))
+        return to_follow, to_unfollow
+    raise ValueError('expected application/json or text/csv')
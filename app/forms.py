@@ -1,7 +1,7 @@
 from flask_wtf import Form
 from wtforms import StringField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, Length
-from app.views import User
+from app.models import User
 
 
 class LoginForm(Form):
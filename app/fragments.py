@@ -0,0 +1,52 @@
+"""
+post.html 渲染结果的缓存。
+
+post 写好以后基本不会再变,时间线每次渲染都把同样的 HTML 再生成一遍没有必要。
+模板里用 {{ render_post(post) }} 代替 {% include 'post.html' %},渲染好的 HTML 存在 FRAGMENT_CACHE 里
+(进程内 LRU,可选 FRAGMENT_CACHE_SHARED 磁盘层,见 app/cache.py)。
+
+每个 post 一个条目,key 是 post id,值里带着渲染时作者的 profile_version 和头像尺寸,
+读的时候这两个对不上就重新渲染:作者在 /edit 改了昵称会让 profile_version 加一,他所有 post 的缓存自然失效。
+post 本身被修改或删除的时候,在事务提交以后删掉它的条目。
+
+post.html 不能依赖当前登录的用户,否则缓存的 HTML 会串到别人的页面上。
+命中率可以在 /stats/cache 看到,用来调整 FRAGMENT_CACHE_SIZE。
+"""
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+from app import app, db
+from .cache import get_cache, on_commit
+from .models import Post
+
+
+def render_post(post, avatar_size=50):
+    if not app.config['FRAGMENT_CACHE']:
+        return Markup(render_template('post.html', post=post, avatar_size=avatar_size))
+    cache = get_cache('FRAGMENT_CACHE')
+    key = 'post:{}'.format(post.id)
+    version = (post.author.profile_version or 0, avatar_size)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return Markup(cached[1])
+    html = render_template('post.html', post=post, avatar_size=avatar_size)
+    cache.set(key, (version, html))
+    return Markup(html)
+
+
+app.jinja_env.globals['render_post'] = render_post
+
+
+@event.listens_for(db.session, 'after_flush')
+def invalidate_posts(session, flush_context):
+    keys = ['post:{}'.format(obj.id) for obj in session.dirty
+            if isinstance(obj, Post) and get_history(obj, 'body').has_changes()]
+    keys.extend('post:{}'.format(obj.id) for obj in session.deleted if isinstance(obj, Post))
+    if keys:
+        cache = get_cache('FRAGMENT_CACHE')
+
+        def delete_fragments():
+            for key in keys:
+                cache.delete(key)
+        on_commit(session, delete_fragments)
@@ -0,0 +1,110 @@
+"""
+带缓存的 Flask-Login user_loader。
+
+以前每个请求在进入视图之前都要 User.query.get(id) 一次。现在把模板需要的几个字段做成一个不可变的快照
+(UserSnapshot),按 (user id, profile_version) 缓存在 USER_CACHE 里(见 app/cache.py),
+current_user 是包着快照的 CachedUser:
+
+- 读快照里有的字段不查数据库;
+- 读快照里没有的属性、调用需要 ORM 对象的方法,或者给属性赋值的时候,才按主键加载完整的 User 并挂上去,
+  之后的读写都走这个 ORM 对象。
+
+profile_version 同时存在 User 表和用户的 session 里。/edit 改了资料以后调用 profile_changed,
+版本号加一,这个 session 下一个请求就会用新的 key 去取快照;别的 worker 里旧版本的快照最多活 USER_CACHE_TTL 秒。
+快照里还有 followed_count,首页的 ETag 要用(见 app/conditional.py),所以关注、取消关注以后也调用 profile_changed。
+"""
+from collections import namedtuple
+from app import db
+from .avatars import email_digest
+from .cache import get_cache, on_commit
+from .models import User
+
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'nickname', 'email_hash', 'about_me', 'profile_version',
+                                           'followed_count'])
+
+
+def snapshot(user):
+    return UserSnapshot(id=user.id,
+                        nickname=user.nickname,
+                        email_hash=user.email_hash or email_digest(user.email),
+                        about_me=user.about_me,
+                        profile_version=user.profile_version or 0,
+                        followed_count=user.followed_count or 0)
+
+
+class CachedUser(object):
+    """
+    当前登录用户的代理,只有真正需要的时候才加载 ORM 对象
+    """
+    def __init__(self, snapshot, model=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_model', model)
+
+    @property
+    def model(self):
+        if self._model is None:
+            object.__setattr__(self, '_model', User.query.get(self._snapshot.id))
+        return self._model
+
+    def __getattr__(self, name):
+        # 只有在类和实例上都找不到的属性才会走到这里
+        if self._model is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.model, name, value)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<CachedUser {}>'.format(self.nickname)
+
+    # 这几个方法只用到 self.id 和 email_hash,直接借用 User 的实现,不用加载 ORM 对象
+    is_following = User.is_following
+    followed_posts = User.followed_posts
+    followed_posts_page = User.followed_posts_page
+    avatar = User.avatar
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
+
+def _key(user_id, version):
+    return 'identity:{}:{}'.format(user_id, version)
+
+
+def load_user(user_id, version=0):
+    cache = get_cache('USER_CACHE')
+    cached = cache.get(_key(user_id, version))
+    if cached is not None:
+        return CachedUser(cached)
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    cache.set(_key(user_id, version), snapshot(user))
+    # 已经加载了,顺便挂上,这个请求里就不用再查一次
+    return CachedUser(snapshot(user), user)
+
+
+def profile_changed(user):
+    """
+    用户改了资料或者关注的人以后调用: 版本号加一,提交以后删掉旧版本的快照。
+    返回新的版本号,调用的视图要把它存进 session['profile_version']
+    """
+    old = user.profile_version or 0
+    user.profile_version = old + 1
+    cache, key = get_cache('USER_CACHE'), _key(user.id, old)
+    on_commit(db.session, lambda: cache.delete(key))
+    return old + 1
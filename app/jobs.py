@@ -0,0 +1,220 @@
+"""
+后台任务队列。
+
+写操作之后那些慢的、又不影响响应内容的事情(发邮件之类)不再在请求里同步做,
+而是 enqueue 一条任务到数据库的 job 表里,请求马上返回。
+
+- enqueue 用的是请求自己的 db.session,任务和业务数据在同一个事务里提交,回滚了任务也就没了;
+- Worker 用几个线程从 job 表里领任务执行。领任务是先选出到期的任务,再用
+  UPDATE ... WHERE status = 'queued' 抢,只有改到了的那个 worker 会执行,多个进程同时跑也不会重复;
+- 任务抛异常会按 JOB_RETRY_DELAY * 2^(重试次数) 推迟重试,超过 JOB_MAX_ATTEMPTS 次标记为 failed;
+- 领了任务的 worker 挂掉的话,超过 JOB_TIMEOUT 秒还是 running 的任务在领任务的时候和到期的任务一样会被领走,
+  不用定期单独执行一条 UPDATE 把它们放回队列:队列空着的时候 worker 只读不写,不会去抢 SQLite 的写锁。
+
+JOB_WORKERS 大于 0 的时候 web 进程里会起这么多个线程,第一次提交任务的时候启动;
+也可以设成 0,用 worker.py 单独跑 worker 进程。
+
+任务函数用 @job 注册,参数必须能转成 JSON:
+
+    @job
+    def send_email(subject, recipients, text_body):
+        ...
+
+    send_email.delay('hi', ['a@example.com'], '...')
+"""
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from app import app, db
+from .cache import on_commit
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key = True)
+    name = db.Column(db.String(64))
+    args = db.Column(db.Text)
+    status = db.Column(db.String(16), default = QUEUED)
+    attempts = db.Column(db.Integer, default = 0)
+    # 最早什么时候可以执行,重试的时候往后推
+    run_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    # worker 按 (status, run_at) 找到期的任务
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    def __repr__(self):
+        return '<Job {} {} {}>'.format(self.id, self.name, self.status)
+
+
+_registry = {}
+
+
+def job(f):
+    """
+    把函数注册成任务,f.delay(*args, **kwargs) 把它放进队列
+    """
+    name = '{}.{}'.format(f.__module__, f.__name__)
+    _registry[name] = f
+    f.job_name = name
+    f.delay = lambda *args, **kwargs: enqueue(f, *args, **kwargs)
+    return f
+
+
+def enqueue(f, *args, **kwargs):
+    """
+    在当前事务里加一条任务,提交以后才会被执行
+    """
+    now = datetime.utcnow()
+    item = Job(name=f.job_name,
+               args=json.dumps({'args': args, 'kwargs': kwargs}),
+               status=QUEUED,
+               attempts=0,
+               run_at=now,
+               created=now)
+    db.session.add(item)
+    on_commit(db.session, workers.notify)
+    return item
+
+
+class Worker(object):
+    def __init__(self, threads=1, poll_interval=1.0, max_attempts=5, retry_delay=10, timeout=600):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._stopping = False
+
+    def due(self, now):
+        """
+        可以领的任务: 到期的排队任务,和领了超过 timeout 秒还没完成的任务(领它的 worker 多半挂了)
+        """
+        stale = now - timedelta(seconds=self.timeout)
+        return or_(and_(Job.status == QUEUED, Job.run_at <= now),
+                   and_(Job.status == RUNNING, Job.locked_at < stale))
+
+    def claim(self):
+        """
+        领一个可以执行的任务,没有的话返回 None
+        """
+        now = datetime.utcnow()
+        while True:
+            item = Job.query.filter(self.due(now))\
+                            .order_by(Job.run_at, Job.id)\
+                            .first()
+            if item is None:
+                db.session.rollback()
+                return None
+            claimed = Job.query.filter(Job.id == item.id, self.due(now))\
+                               .update({'status': RUNNING, 'locked_by': self.name, 'locked_at': now,
+                                        'attempts': Job.attempts + 1},
+                                       synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return item
+            # 被别的 worker 抢走了,再找下一个
+
+    def execute(self, item):
+        f = _registry.get(item.name)
+        try:
+            if f is None:
+                raise LookupError('Unknown job: {}'.format(item.name))
+            payload = json.loads(item.args)
+            f(*payload['args'], **payload['kwargs'])
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('job {} failed'.format(item))
+            item.last_error = repr(e)
+            item.locked_by = item.locked_at = None
+            if item.attempts >= self.max_attempts or f is None:
+                item.status = FAILED
+                self.failed += 1
+            else:
+                item.status = QUEUED
+                item.run_at = datetime.utcnow() + timedelta(seconds=self.retry_delay * 2 ** (item.attempts - 1))
+                self.retried += 1
+        else:
+            item.status = DONE
+            item.locked_by = item.locked_at = None
+            self.done += 1
+        db.session.commit()
+
+    def run_pending(self):
+        """
+        把当前到期的任务都执行完,返回执行的数目。调用的地方要有 app context
+        """
+        count = 0
+        while not self._stopping:
+            item = self.claim()
+            if item is None:
+                break
+            self.execute(item)
+            count += 1
+        return count
+
+    def stats(self):
+        return {'done': self.done, 'failed': self.failed, 'retried': self.retried,
+                'threads': len(self._threads)}
+
+    def notify(self):
+        if not self._threads and app.config['JOB_WORKERS']:
+            self.start(app.config['JOB_WORKERS'])
+        self._wakeup.set()
+
+    def start(self, threads=None):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(threads or self.threads):
+                thread = threading.Thread(target=self._run, name='job-worker-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """
+        等正在执行的任务做完以后停掉所有线程
+        """
+        self._stopping = True
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        with app.app_context():
+            while not self._stopping:
+                try:
+                    self.run_pending()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('job worker error')
+                finally:
+                    db.session.remove()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+workers = Worker(threads=app.config.get('JOB_WORKERS', 2),
+                 poll_interval=app.config.get('JOB_POLL_INTERVAL', 1.0),
+                 max_attempts=app.config.get('JOB_MAX_ATTEMPTS', 5),
+                 retry_delay=app.config.get('JOB_RETRY_DELAY', 10),
+                 timeout=app.config.get('JOB_TIMEOUT', 600))
+atexit.register(workers.stop)
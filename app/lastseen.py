@@ -0,0 +1,109 @@
+"""
+last_seen 的写回缓冲(write-behind)。
+
+以前 before_request 每个请求都要 commit 一次来更新 last_seen,SQLite 只有一把写锁,所有请求都排队等它。
+现在请求里只在内存里记一下 "用户 x 在 t 时刻来过",同一个用户的多次访问合并成一条,
+后台线程每 LAST_SEEN_FLUSH_INTERVAL 秒,或者攒够 LAST_SEEN_FLUSH_SIZE 个用户的时候,
+用一条 executemany 的 UPDATE 一次写回。数据库里的 last_seen 最多落后 LAST_SEEN_FLUSH_INTERVAL 秒。
+进程退出的时候会把剩下的写完。
+
+stats() 返回计数,commits_saved 就是省掉的 commit 次数,/stats/lastseen 返回的就是它。
+"""
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import bindparam
+from app import app, db
+from .models import User
+
+
+class LastSeenTracker(object):
+    def __init__(self, flush_interval=30, flush_size=500, autostart=True):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.autostart = autostart
+        self.touches = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def touch(self, user_id, when=None):
+        with self._lock:
+            self._pending[user_id] = when or datetime.utcnow()
+            self.touches += 1
+            full = len(self._pending) >= self.flush_size
+        if self.autostart and self._thread is None:
+            self.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        users = User.__table__
+        rows = [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()]
+        try:
+            with app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(users.update()
+                                            .where(users.c.id == bindparam('user_id'))
+                                            .values(last_seen=bindparam('seen')), rows)
+        except Exception:
+            # 写失败了把数据放回去等下一次,期间有更新的访问记录就以新的为准
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            raise
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return len(rows)
+
+    def stats(self):
+        return {'touches': self.touches,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'pending': len(self._pending),
+                'commits_saved': self.touches - self.flushes}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='last-seen-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        停掉后台线程并把剩下的写回去
+        """
+        thread = self._thread
+        if thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+        if self.touches:
+            app.logger.info('last_seen tracker stopped: {}'.format(self.stats()))
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('last_seen flush failed')
+
+
+tracker = LastSeenTracker(flush_interval=app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30),
+                          flush_size=app.config.get('LAST_SEEN_FLUSH_SIZE', 500))
+atexit.register(tracker.stop)
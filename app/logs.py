@@ -0,0 +1,187 @@
+"""
+不阻塞请求的错误日志。
+
+以前非 debug 模式直接在 app.logger 上挂 SMTPHandler 和 RotatingFileHandler:
+每个 ERROR 都要在请求线程里连一次 SMTP 服务器,每行日志都要同步写文件、检查要不要滚动。
+
+现在 app.logger 上只有一个 QueueHandler,请求线程只是把日志记录放进内存队列,
+由一个单独的监听线程(QueueListener)交给真正的 handler:
+
+- 文件日志: RotatingFileHandler,日志文件的大小限制在 LOG_FILE_MAX_BYTES,保留最后 LOG_FILE_BACKUPS 个。
+  LOG_JSON 打开以后每行是一个 JSON 对象,方便日志系统解析;
+- 错误邮件: BatchingSMTPHandler,LOG_MAIL_INTERVAL 秒内最多发一封,期间的错误攒起来放在同一封里,
+  一封最多 LOG_MAIL_BATCH 条,多出来的只计数。
+
+队列最多 LOG_QUEUE_SIZE 条,满了就丢掉最旧的,日志风暴的时候请求也不会卡在写日志上。
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import localtime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+
+class DropOldestQueue(queue.Queue):
+    """
+    有界队列,满了的时候丢掉最旧的记录而不是阻塞或者丢掉新的
+    """
+    def __init__(self, maxsize):
+        queue.Queue.__init__(self, maxsize)
+        self.dropped = 0
+
+    def put_nowait(self, item):
+        while True:
+            try:
+                return queue.Queue.put_nowait(self, item)
+            except queue.Full:
+                try:
+                    self.get_nowait()
+                    self.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # 参数和异常在请求线程里就格式化好,监听线程里不再碰请求里的对象。
+        # 异常放在 exc_text 里,下游的 formatter(包括 JSON)自己决定怎么输出
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'path': record.pathname,
+                'line': record.lineno,
+                'thread': record.threadName}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class BatchingSMTPHandler(SMTPHandler):
+    """
+    interval 秒内最多发一封邮件。距离上一封已经超过 interval 秒就马上发,
+    否则先攒着,到时间由定时器一起发出去
+    """
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, interval=60, capacity=100):
+        SMTPHandler.__init__(self, mailhost, fromaddr, toaddrs, subject, credentials=credentials)
+        self.interval = interval
+        self.capacity = capacity
+        self.buffer = []
+        self.skipped = 0
+        self.sent = 0
+        self.last_sent = 0
+        self._timer = None
+
+    def emit(self, record):
+        if len(self.buffer) < self.capacity:
+            self.buffer.append(record)
+        else:
+            self.skipped += 1
+        wait = self.last_sent + self.interval - time.time()
+        if wait <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(wait, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            records, skipped = self.buffer, self.skipped
+            self.buffer, self.skipped = [], 0
+            if not records:
+                return
+            self.last_sent = time.time()
+            try:
+                self.send(records, skipped)
+                self.sent += 1
+            except Exception:
+                self.handleError(records[0])
+        finally:
+            self.release()
+
+    def send(self, records, skipped):
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = '{} ({} errors)'.format(self.subject, len(records) + skipped)
+        msg['Date'] = localtime()
+        body = '\n\n'.join(self.format(record) for record in records)
+        if skipped:
+            body += '\n\n... and {} more'.format(skipped)
+        msg.set_content(body)
+        smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT, timeout=self.timeout)
+        try:
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(msg)
+        finally:
+            smtp.quit()
+
+    def close(self):
+        self.flush()
+        SMTPHandler.close(self)
+
+
+def init_app(app):
+    """
+    给 app.logger 挂上队列,启动监听线程,返回 QueueListener
+    """
+    config = app.config
+    formatter = JSONFormatter() if config['LOG_JSON'] else logging.Formatter(TEXT_FORMAT)
+    handlers = []
+    if config['LOG_FILE']:
+        if not os.path.isdir(os.path.dirname(config['LOG_FILE'])):
+            os.makedirs(os.path.dirname(config['LOG_FILE']))
+        file_handler = RotatingFileHandler(config['LOG_FILE'], 'a',
+                                           config['LOG_FILE_MAX_BYTES'], config['LOG_FILE_BACKUPS'])
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+    if config['MAIL_SERVER'] and config['ADMINS']:
+        credentials = None
+        if config['MAIL_USERNAME'] or config['MAIL_PASSWORD']:
+            credentials = (config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        mail_handler = BatchingSMTPHandler((config['MAIL_SERVER'], config['MAIL_PORT']),
+                                           'no-reply@' + config['MAIL_SERVER'], config['ADMINS'],
+                                           'microblog failure', credentials,
+                                           interval=config['LOG_MAIL_INTERVAL'],
+                                           capacity=config['LOG_MAIL_BATCH'])
+        mail_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+    log_queue = DropOldestQueue(config['LOG_QUEUE_SIZE'])
+    app.logger.addHandler(LogQueueHandler(log_queue))
+    app.logger.setLevel(logging.INFO)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出的时候先把队列里剩下的处理完, logging 自己的 shutdown 再关掉 handler(错误邮件会在那时发出去)
+    atexit.register(listener.stop)
+    return listener
@@ -1,22 +1,119 @@
-from app import db
-from hashlib import md5
+from importlib import import_module
+from app import app, db
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from .avatars import avatar_url, email_digest
+from .cache import get_cache, on_commit
+from .pagination import paginate
+
+
+def timeline_backend():
+    # timeline 模块依赖本模块里的模型,所以在用到的时候再导入
+    from app.timeline import get_backend
+    return get_backend()
+
+
+def post_archive():
+    from app import archive
+    return archive
+
+
+def recommender():
+    from app.recommend import recommender
+    return recommender
+
 
 # 一个多对多的关注与被关注的关系表
 # 我们并没有像对 users 和 posts 一样把它声明为一个模式。
 # 因为这是一个辅助表，我们使用 flask-sqlalchemy 中的低级的 APIs 来创建没有使用关联模式。
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+                     # 同一对关系只能有一行,批量关注的去重查询也走这个索引,见 app/follows.py
+                     db.Index('ix_followers_pair', 'follower_id', 'followed_id', unique=True)
                      )
 
 
+def insert_follow(session, follower_id, followed_id):
+    """
+    插入一条关注关系,已经有了就什么都不做(冲突在 ix_followers_pair 上),返回插入的行数。
+    别的进程刚插了同一行也不会违反唯一约束
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        statement = followers.insert().prefix_with('IGNORE')
+    else:
+        statement = import_module('sqlalchemy.dialects.' + dialect).insert(followers).on_conflict_do_nothing()
+    return session.execute(statement.values(follower_id=follower_id, followed_id=followed_id)).rowcount
+
+
+def delete_follow(session, follower_id, followed_id):
+    """
+    删掉一条关注关系,返回删掉的行数,没有这条关系的时候是 0
+    """
+    return session.execute(followers.delete()
+                                    .where(followers.c.follower_id == follower_id)
+                                    .where(followers.c.followed_id == followed_id)).rowcount
+
+
+def update_follower_counts(session, ids, delta):
+    """
+    给 ids 这些人的 follower_count 加上 delta。直接执行 UPDATE ... SET x = x + n,
+    不是给属性赋一个 SQL 表达式:那样同一个事务里还没 flush 的上一次加一会被覆盖掉
+    """
+    users = User.__table__
+    session.execute(users.update()
+                         .where(users.c.id.in_(ids))
+                         .values(follower_count=users.c.follower_count + delta))
+    _expire_counts(session, ids)
+
+
+def update_followed_count(session, user, delta):
+    users = User.__table__
+    session.execute(users.update()
+                         .where(users.c.id == user.id)
+                         .values(followed_count=users.c.followed_count + delta))
+    _expire_counts(session, [user.id])
+
+
+def _expire_counts(session, ids):
+    # 内存里的对象要重新读计数
+    for user_id in ids:
+        obj = session.identity_map.get(session.identity_key(User, user_id))
+        if obj is not None:
+            session.expire(obj, ['follower_count', 'followed_count'])
+
+
+# 物化的首页时间线(fan-out on write)。
+# 每发一条 post 就把 (粉丝 id, post id, 时间戳) 写进每个粉丝的时间线里，
+# 读首页时只需要在 (user_id, timestamp, post_id) 索引上做一次有界的范围扫描，
+# 不用再把 followers 和 post 连接起来整体排序。具体的读写逻辑见 app/timeline.py。
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp', 'post_id')
+                    )
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     nickname = db.Column(db.String(64), index = True, unique = True)
     email = db.Column(db.String(120), index = True, unique = True)
+    # 邮箱的 MD5,设置 email 的时候自动更新,用来生成头像 URL
+    email_hash = db.Column(db.String(32))
     posts = db.relationship('Post', backref = 'author', lazy = 'dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    # 冗余的计数字段,由 follow/unfollow 和发 post 在同一个事务里维护,
+    # 渲染个人主页不用再去 COUNT followers/post 表。漂移了用 db_reconcile_counters.py 修复
+    follower_count = db.Column(db.Integer, index = True, default = 0, server_default = '0')
+    followed_count = db.Column(db.Integer, default = 0, server_default = '0')
+    post_count = db.Column(db.Integer, default = 0, server_default = '0')
+    # 资料每改一次加一,缓存的登录用户快照按这个版本号失效,见 app/identity.py
+    profile_version = db.Column(db.Integer, default = 0, server_default = '0')
     """
     ‘User’ 是这种关系中的右边的表(实体)(左边的表/实体是父类)。
     因为定义一个自我指向的关系，我们在两边使用同样的类。
@@ -38,23 +135,89 @@ class User(db.Model):
                                lazy='dynamic'
                                )
 
+    """
+    follow/unfollow 直接对 followers 表执行 INSERT ... ON CONFLICT DO NOTHING / DELETE,
+    由影响的行数决定要不要改计数和时间线,不看 FOLLOW_CACHE: 缓存里的关注状态可能是这个进程几分钟前看到的,
+    只拿来渲染页面。已经关注了(或者本来就没关注)的时候返回 None
+    """
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        if self.id is None or user.id is None:
+            db.session.flush()
+        if insert_follow(db.session, self.id, user.id):
+            # UPDATE ... SET x = x + 1 马上执行,并发更新和同一个事务里的多次关注都不会丢
+            update_followed_count(db.session, self, 1)
+            update_follower_counts(db.session, [user.id], 1)
+            timeline_backend().follow(self, user)
+            self._follow_changed(user, True)
             return self
 
     def unfollow(self, user):
-        if self.is_followed.remove(user):
-            self.followed.remove(user)
+        if self.id is None or user.id is None:
+            db.session.flush()
+        if delete_follow(db.session, self.id, user.id):
+            update_followed_count(db.session, self, -1)
+            update_follower_counts(db.session, [user.id], -1)
+            timeline_backend().unfollow(self, user)
+            self._follow_changed(user, False)
             return self
 
+    def follow_many(self, users, batch_size=None):
+        """
+        一次关注很多人(User 对象或者 id),按批用集合操作完成,返回 app.follows.BulkResult
+        """
+        from app.follows import follow_many
+        return follow_many(self, users, batch_size)
+
+    def unfollow_many(self, users, batch_size=None):
+        from app.follows import unfollow_many
+        return unfollow_many(self, users, batch_size)
+
+    """
+    关注关系缓存在 FOLLOW_CACHE 里(进程内 LRU + 可选的共享缓存,见 app/cache.py),
+    关注数直接读 User 上的计数字段,缓存热了以后渲染个人主页不需要再查 followers 表。
+    follow/unfollow 在事务提交以后把新的关注状态写进缓存。
+    """
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        if self.id is None or user.id is None:
+            return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return get_cache('FOLLOW_CACHE').get_or_set(
+            'following:{}:{}'.format(self.id, user.id),
+            lambda: self.followed.filter(followers.c.followed_id == user.id).count() > 0)
+
+    def _follow_changed(self, user, following):
+        cache = get_cache('FOLLOW_CACHE')
+        # 提交以后对象会过期,这里先把 key 算好,回调里不能再去访问数据库
+        following_key = 'following:{}:{}'.format(self.id, user.id)
+        follower_id, followed_id = self.id, user.id
+        on_commit(db.session, lambda: cache.set(following_key, following))
+        on_commit(db.session, lambda: recommender().changed(follower_id, [followed_id], following))
+
+    """
+    下面几个返回 post 列表的方法都会顺带把作者加载出来,免得模板里每个 post.author 再查一次(N+1)。
+    loading 可以是 'selectin'、'joined' 或 'lazy',默认用 POST_AUTHOR_LOADING 配置,见 with_authors
+    """
+    def followed_posts(self, loading=None):
+        """
+        首页时间线,具体怎么查由 TIMELINE_BACKEND 配置的后端决定,见 app/timeline.py
+        """
+        return timeline_backend().posts(self, loading=loading)
+
+    def followed_posts_page(self, per_page, after=None, before=None, loading=None):
+        """
+        按 (timestamp, id) 游标分页的首页时间线,返回 app.pagination.Page
+        """
+        return timeline_backend().page(self, per_page, after=after, before=before, loading=loading)
 
-    def followed_posts(self):
-        return Post.query.join(followers, (followers.c.followed_id == Post.user_id))\
-                        .filter(followers.c.follower_id == self.id)\
-                        .order_by(Post.timestamp.desc())
+    def posts_page(self, per_page, after=None, before=None):
+        """
+        按 (timestamp, id) 游标分页的个人 post 列表,走 Post 上的 (user_id, timestamp, id) 索引,
+        翻到归档的时间范围以后接着查归档表。这些 post 的作者都是自己,直接设置上去,不用再查
+        """
+        page = paginate([(self.posts, Post.timestamp, Post.id)], per_page, after=after, before=before,
+                        archives=post_archive().profile_tiers(self))
+        for post in page.items:
+            set_committed_value(post, 'author', self)
+        return page
 
     def avatar(self, size):
         """
@@ -66,23 +229,53 @@ class User(db.Model):
         mm 选项将会返回一个“神秘人”图片，一个人灰色的轮廓。
         s=N 选项要求头像按照以像素为单位的给定尺寸缩放。
         详见: https://gravatar.com/site/implement/images
+        邮箱的 MD5 存在 email_hash 里,URL 按 (digest, size) 缓存,见 app/avatars.py
         """
-        return 'http://www.gravatar.com/avatar/' + md5(self.email).hexdigest() + '?=mm&s=' + str(size)
+        return avatar_url(self.email_hash or email_digest(self.email), size)
 
     @staticmethod
     def make_unique_nickname(nickname):
         """
-        防止出现重名
+        防止出现重名。昵称被占用的时候在后面加上最小的空闲数字: john2, john3, ...
+        以前每试一个候选名就查一次,常见的名字注册一次要查几十上百次。
+        现在一条查询在 nickname 索引上做前缀范围扫描,把 nickname 本身和 "nickname + 数字" 开头的昵称都取出来,
+        在内存里找空闲的后缀,不管已经有多少个重名都只查一次
         """
-        if User.query.fileter_by(nickname=nickname).first() is None:
+        # ':' 是 '9' 后面的字符,[nickname, nickname + ':') 覆盖了 nickname 和所有 nickname<数字...>
+        rows = db.session.query(User.nickname)\
+                         .filter(User.nickname >= nickname, User.nickname < nickname + ':')
+        taken, used = False, set()
+        for row in rows:
+            suffix = row[0][len(nickname):]
+            if not suffix:
+                taken = True
+            elif suffix.isdigit() and suffix[0] != '0':
+                used.add(int(suffix))
+        if not taken:
             return nickname
-        version, new_nickname = 2, ''
-        while True:
-            new_nickname = nickname + str(version)
-            if User.query.fileter_by(nickname=new_nickname).first() is None:
-                break
+        version = 2
+        while version in used:
             version += 1
-        return new_nickname
+        return nickname + str(version)
+
+    @staticmethod
+    def register(nickname, email, attempts=5):
+        """
+        用不重名的昵称创建新用户并提交。
+        两个同名的人同时注册的时候可能拿到同一个昵称,后提交的那个违反唯一约束,回滚以后重新分配。
+        别的约束(比如邮箱重复)重新分配昵称也没用,直接抛出
+        """
+        for attempt in range(attempts):
+            user = User(nickname=User.make_unique_nickname(nickname), email=email)
+            db.session.add(user)
+            try:
+                db.session.commit()
+                return user
+            except IntegrityError as e:
+                db.session.rollback()
+                # 各个数据库的报错里都有列名或者索引名: user.nickname、ix_user_nickname
+                if 'nickname' not in str(e.orig) or attempt == attempts - 1:
+                    raise
 
     def __repr__(self):
         # __repr__ 方法告诉 Python 如何打印这个类的对象。我们将用它来调试。
@@ -116,14 +309,40 @@ class User(db.Model):
         #     return str(self.id)  # python 3
 
 
+@event.listens_for(User.email, 'set')
+def update_email_hash(target, value, oldvalue, initiator):
+    target.email_hash = email_digest(value) if value else None
+
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # 写的时候有没有扇出到粉丝的 timeline 表。False 的(大V 发的)读首页的时候再合并,见 app/timeline.py
+    fanned_out = db.Column(db.Boolean, default = True, server_default = '1')
+    # 个人主页按 (timestamp, id) 游标分页,这个复合索引让每一页都是一次有界的范围扫描
+    __table_args__ = (db.Index('ix_post_user_timestamp', 'user_id', 'timestamp', 'id'),
+                      db.Index('ix_post_user_fanned_out', 'user_id', 'fanned_out', 'timestamp', 'id'))
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
 
-
+def with_authors(query, loading=None, entity=None):
+    """
+    给 post 查询加上作者的加载策略:
+    selectin 查完 post 以后再用一条 IN 查询把这一页所有的作者取出来;
+    joined   在同一条查询里 LEFT JOIN user 表;
+    lazy     不预先加载,每个作者第一次访问的时候单独查一次。
+    entity 默认是 Post,查归档表的时候是对应的 ArchivedPost 类,见 app/archive.py
+    """
+    loading = loading or app.config.get('POST_AUTHOR_LOADING', 'selectin')
+    author = (entity or Post).author
+    if loading == 'selectin':
+        return query.options(selectinload(author))
+    if loading == 'joined':
+        return query.options(joinedload(author))
+    if loading == 'lazy':
+        return query
+    raise ValueError('Unknown author loading strategy: {}'.format(loading))
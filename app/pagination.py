@@ -0,0 +1,125 @@
+"""
+键集(游标)分页。
+
+OFFSET 分页翻到第 N 页时数据库要先数过前面 N * per_page 行,越往后越慢。
+这里用上一页最后一条的 (timestamp, id) 作为游标,下一页只取比它"更旧"的行,
+配合 (..., timestamp, id) 的复合索引,不管翻多深每页都只读 per_page + 1 行。
+游标编码成不透明的字符串放在 URL 的 after / before 参数里。
+"""
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_
+from .database import read_session
+
+
+def encode_cursor(timestamp, ident):
+    raw = '{}|{}'.format(timestamp.isoformat(), ident)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    解码游标,返回 (timestamp, id); 不合法的游标返回 None,当作第一页处理
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, ident = raw.split('|')
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%dT%H:%M:%S'
+        return datetime.strptime(timestamp, fmt), int(ident)
+    except (ValueError, TypeError):
+        return None
+
+
+class Page(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _key(post):
+    return post.timestamp, post.id
+
+
+def paginate(branches, per_page, after=None, before=None, archives=()):
+    """
+    :param branches: [(未排序的查询, 时间列, id 列), ...]。
+                     每个分支各自按游标过滤、排序并取 per_page + 1 行,然后在内存里归并去重。
+    :param after: 取比这个游标更旧的一页(下一页)
+    :param before: 取比这个游标更新的一页(上一页)
+    :param archives: 比 branches 更旧的归档层 [(分支列表, 起始时间, 结束时间), ...],从新到旧排列,见 app/archive.py。
+                     各层的时间不重叠,按翻页的方向一层一层往下查,凑够一页就不再查后面的层,
+                     所以只看最近的几页时根本不会碰到归档
+    """
+    cursor = decode_cursor(before)
+    backwards = cursor is not None
+    if not backwards:
+        cursor = decode_cursor(after)
+    tiers = [branches]
+    for archived, start, end in archives:
+        # 整层都在游标的另一边的就不用查了
+        if cursor is not None and (start > cursor[0] if not backwards else end <= cursor[0]):
+            continue
+        tiers.append(archived)
+    if backwards:
+        tiers.reverse()
+    rows = {}
+    for tier in tiers:
+        for query, timestamp, ident in tier:
+            # 在 @read_only 的视图里走只读副本
+            query = query.with_session(read_session())
+            if cursor is not None:
+                cursor_timestamp, cursor_id = cursor
+                if backwards:
+                    query = query.filter(or_(timestamp > cursor_timestamp,
+                                             and_(timestamp == cursor_timestamp, ident > cursor_id)))
+                else:
+                    query = query.filter(or_(timestamp < cursor_timestamp,
+                                             and_(timestamp == cursor_timestamp, ident < cursor_id)))
+            if backwards:
+                query = query.order_by(timestamp.asc(), ident.asc())
+            else:
+                query = query.order_by(timestamp.desc(), ident.desc())
+            for row in query.limit(per_page + 1):
+                rows[row.id] = row
+        if len(rows) > per_page:
+            break
+    rows = sorted(rows.values(), key=_key, reverse=not backwards)
+    more = len(rows) > per_page
+    items = rows[:per_page]
+    if backwards:
+        items.reverse()
+    if not items:
+        return Page(items)
+    # 往后翻的时候"更新的一页"一定存在(我们就是从那里翻过来的),反之亦然
+    has_next = more if not backwards else True
+    has_prev = more if backwards else cursor is not None
+    return Page(items,
+                next_cursor=encode_cursor(*_key(items[-1])) if has_next else None,
+                prev_cursor=encode_cursor(*_key(items[0])) if has_prev else None)
+
+
+def newest(branches):
+    """
+    各个分支里最新一行的 (timestamp, id),都是空的返回 None。
+    每个分支只在索引上倒着读一行,拿来生成 ETag 之类的很便宜
+    """
+    keys = []
+    for query, timestamp, ident in branches:
+        row = query.with_session(read_session())\
+                   .with_entities(timestamp, ident)\
+                   .order_by(timestamp.desc(), ident.desc())\
+                   .first()
+        if row is not None:
+            keys.append((row[0], row[1]))
+    return max(keys) if keys else None
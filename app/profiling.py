@@ -0,0 +1,175 @@
+"""
+每个请求的 SQL 和耗时统计。
+
+PROFILING 打开以后,每个请求记录:
+- SQL 的条数和总耗时(SQLAlchemy 的 before/after_cursor_execute 事件);
+- 最慢的 PROFILING_TOP_QUERIES 条语句,以及它们是从 app 里哪一行发出来的;
+- 模板渲染的时间(Flask 的 before_render_template / template_rendered 信号,只算最外层)。
+
+结果有三个去处:
+- 响应头 Server-Timing,浏览器的开发者工具里可以直接看到;
+- 超过 PROFILING_SLOW_MS 的请求按 PROFILING_LOG_SAMPLE 的比例抽样写进日志,带上最慢的语句;
+- 进程内按路由汇总的直方图,/stats/requests 返回 JSON。
+
+关掉的时候每个钩子只看一下 thread local 里有没有当前请求的记录就返回,几乎没有开销。
+"""
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from flask import before_render_template, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+_local = threading.local()
+_app_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class RequestProfile(object):
+    def __init__(self, top):
+        self.started = time.time()
+        self.top = top
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = []
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+
+    def add_query(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        if len(self.slowest) < self.top or duration > self.slowest[-1][0]:
+            # 只有进了前几名才去找调用的位置
+            self.slowest.append((duration, statement, call_site()))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.top:]
+
+
+def call_site():
+    """
+    调用栈上第一个在 app 目录里、又不是本模块的帧,返回 "文件:行号 函数名"
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_app_dir) and not filename.endswith('profiling.py'):
+            return '{}:{} {}'.format(os.path.relpath(filename, os.path.dirname(_app_dir)),
+                                     frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class RouteStats(object):
+    """
+    一个路由的汇总:请求数、总耗时、SQL 条数,以及按 PROFILING_BUCKETS (毫秒)分桶的耗时直方图
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.requests = 0
+        self.total_ms = 0.0
+        self.db_ms = 0.0
+        self.queries = 0
+        self.max_ms = 0.0
+
+    def add(self, total_ms, db_ms, queries):
+        self.counts[bisect_left(self.buckets, total_ms)] += 1
+        self.requests += 1
+        self.total_ms += total_ms
+        self.db_ms += db_ms
+        self.queries += queries
+        self.max_ms = max(self.max_ms, total_ms)
+
+    def to_dict(self):
+        labels = ['<={}ms'.format(b) for b in self.buckets] + ['>{}ms'.format(self.buckets[-1])]
+        return {'requests': self.requests,
+                'mean_ms': self.total_ms / self.requests,
+                'mean_db_ms': self.db_ms / self.requests,
+                'queries_per_request': float(self.queries) / self.requests,
+                'max_ms': self.max_ms,
+                'histogram': dict(zip(labels, self.counts))}
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def request_stats():
+    with _stats_lock:
+        return dict((route, stats.to_dict()) for route, stats in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+@app.before_request
+def start_profile():
+    if app.config['PROFILING']:
+        _local.profile = RequestProfile(app.config['PROFILING_TOP_QUERIES'])
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'profile', None) is not None:
+        conn.info.setdefault('profiling_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and conn.info.get('profiling_started'):
+        profile.add_query(statement, time.time() - conn.info['profiling_started'].pop())
+
+
+@before_render_template.connect_via(app)
+def before_render(sender, template, context, **extra):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        if profile.template_depth == 0:
+            profile.template_started = time.time()
+        profile.template_depth += 1
+
+
+@template_rendered.connect_via(app)
+def after_render(sender, template, context, **extra):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and profile.template_depth:
+        profile.template_depth -= 1
+        if profile.template_depth == 0:
+            profile.template_time += time.time() - profile.template_started
+
+
+@app.after_request
+def finish_profile(response):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return response
+    _local.profile = None
+    total_ms = (time.time() - profile.started) * 1000
+    db_ms = profile.db_time * 1000
+    response.headers['Server-Timing'] = 'db;dur={:.1f};desc="{} queries", tpl;dur={:.1f}, total;dur={:.1f}'.format(
+        db_ms, profile.queries, profile.template_time * 1000, total_ms)
+    route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    with _stats_lock:
+        stats = _stats.get(route)
+        if stats is None:
+            stats = _stats[route] = RouteStats(app.config['PROFILING_BUCKETS'])
+        stats.add(total_ms, db_ms, profile.queries)
+    if total_ms > app.config['PROFILING_SLOW_MS'] and random.random() < app.config['PROFILING_LOG_SAMPLE']:
+        app.logger.warning('slow request {} {}: {:.1f}ms, {} queries in {:.1f}ms, templates {:.1f}ms\n{}'.format(
+            request.method, request.path, total_ms, profile.queries, db_ms, profile.template_time * 1000,
+            '\n'.join('  {:.1f}ms at {}: {}'.format(duration * 1000, site, ' '.join(statement.split()))
+                      for duration, statement, site in profile.slowest)))
+    return response
+
+
+@app.teardown_request
+def discard_profile(exception=None):
+    # 出了异常 after_request 不会执行,这里保证不会带到下一个请求
+    _local.profile = None
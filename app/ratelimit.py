@@ -0,0 +1,176 @@
+"""
+关注、取消关注和登录的限流。
+
+这几个视图每次都要写数据库(登录还要去 OpenID 提供商),SQLite 只有一把写锁,
+一个客户端不停地刷就能让所有别的请求都排队。这里给它们加上令牌桶:
+
+    @app.route('/follow/<nickname>')
+    @ratelimit.limit('RATELIMIT_FOLLOW')
+    @login_required
+    def follow(nickname):
+
+配置 RATELIMIT_FOLLOW = '30/minute' 表示桶里最多 30 个令牌,每 2 秒补一个,每个请求拿走一个。
+默认按登录用户(session 里的用户 id)和客户端 IP 各一个桶,两个桶都有令牌才放行,
+所以换 IP 或者换账号都绕不过去。
+
+检查放在最早的 before_request 里,在 Flask-Login 加载用户、last_seen、视图之前:
+用户 id 直接从 session cookie 里读,被拒绝的请求只是查了一下内存里的字典,
+返回 429 和 Retry-After,不会碰数据库,也不渲染用到当前用户的模板。
+
+桶放在进程内有上限的 LRU 字典里(RATELIMIT_MAX_KEYS 个,每个只是一个 (令牌数, 时间) 元组),
+满了丢掉最久没用的,丢掉的桶下次按满的算。多个进程要共享限额的时候设置 RATELIMIT_SHARED,
+和 app/cache.py 的共享缓存一样用一个加了文件锁的 shelve 文件。
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask import request, session
+from app import app
+from .cache import ShelveCache
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+_limits = {}
+
+
+def parse_limit(value):
+    """
+    '30/minute' -> (容量 30, 每秒补 0.5 个);也可以写成 '30/120' 表示 120 秒 30 个
+    """
+    limit = _limits.get(value)
+    if limit is None:
+        count, _, period = value.partition('/')
+        seconds = PERIODS.get(period.strip()) or float(period)
+        limit = _limits[value] = (int(count), int(count) / float(seconds))
+    return limit
+
+
+def take_tokens(buckets, requests, now):
+    """
+    :param buckets: 存桶的字典,key -> (令牌数, 上次更新的时间)
+    :param requests: [(key, 容量, 每秒补充的令牌数), ...]
+    :return: (是否放行, 要等的秒数, 要写回的 {key: 桶}),不放行的时候一个令牌都不拿
+    """
+    allowed, wait, updated = True, 0.0, {}
+    for key, capacity, rate in requests:
+        tokens, stamp = buckets.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - stamp) * rate)
+        if tokens < 1:
+            allowed = False
+            wait = max(wait, (1 - tokens) / rate)
+        updated[key] = (tokens - 1, now)
+    return allowed, wait, updated if allowed else {}
+
+
+class BucketStore(object):
+    """
+    进程内的桶,最多 max_keys 个
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, requests, now=None):
+        with self._lock:
+            allowed, wait, updated = take_tokens(self._buckets, requests, now or time.time())
+            for key, bucket in updated.items():
+                self._buckets[key] = bucket
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SharedBucketStore(ShelveCache):
+    """
+    多个进程共享的桶,读和写在同一把文件锁里完成
+    """
+    def take(self, requests, now=None):
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                allowed, wait, updated = take_tokens(shelf, requests, now or time.time())
+                for key, bucket in updated.items():
+                    shelf[key] = bucket
+            finally:
+                self._close(lock_file, shelf)
+        return allowed, wait
+
+    def __len__(self):
+        with self._lock:
+            lock_file, shelf = self._open()
+            try:
+                return len(shelf)
+            finally:
+                self._close(lock_file, shelf)
+
+
+_store = None
+_store_lock = threading.Lock()
+_counts = {'allowed': 0, 'rejected': 0}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if app.config['RATELIMIT_SHARED']:
+                    _store = SharedBucketStore(app.config['RATELIMIT_SHARED'])
+                else:
+                    _store = BucketStore(app.config['RATELIMIT_MAX_KEYS'])
+    return _store
+
+
+def reset():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.clear()
+        _store = None
+        _counts.update(allowed=0, rejected=0)
+
+
+def stats():
+    return dict(_counts, buckets=len(_store) if _store is not None else 0)
+
+
+def limit(name, by=('user', 'ip')):
+    """
+    给视图加上限流。name 是配置项的名字,by 是按什么分桶: 'user' 登录用户, 'ip' 客户端地址
+    """
+    def decorator(f):
+        f.rate_limits = getattr(f, 'rate_limits', []) + [(name, by)]
+        return f
+    return decorator
+
+
+@app.before_request
+def check_rate_limits():
+    if not app.config['RATELIMIT'] or request.endpoint is None:
+        return
+    limits = getattr(app.view_functions.get(request.endpoint), 'rate_limits', None)
+    if not limits:
+        return
+    identities = {'user': session.get('_user_id'), 'ip': request.remote_addr}
+    requests = []
+    for name, by in limits:
+        capacity, rate = parse_limit(app.config[name])
+        requests.extend(('{}:{}:{}'.format(name, kind, identities[kind]), capacity, rate)
+                        for kind in by if identities.get(kind) is not None)
+    allowed, wait = get_store().take(requests)
+    if allowed:
+        _counts['allowed'] += 1
+        return
+    _counts['rejected'] += 1
+    response = app.response_class('Too many requests, please try again later.\n', 429, mimetype='text/plain')
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
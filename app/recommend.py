@@ -0,0 +1,287 @@
+"""
+"Who to follow":你关注的人还关注了谁。
+
+直接在 followers 表上做二度关系要两次自连接,关注多的用户一次就是几十万行,请求里做不了。
+这里把整张 followers 表读进内存,存成 CSR (compressed sparse row) 格式的三个整数数组:
+
+    nodes    有关注别人的用户 id,升序
+    offsets  nodes[i] 关注的人是 targets[offsets[i]:offsets[i + 1]]
+    targets  被关注的用户 id,每个人的那一段升序
+
+每条边只占 targets 里的 4 个字节,没有 ORM 对象,也没有每个用户一个 set。找某个用户关注的人是
+nodes 上的一次二分查找加一次切片。推荐就是把他关注的每个人关注的人数一遍,按共同关注的人数排序,
+去掉自己和已经关注的;每个人最多看 RECOMMEND_MAX_FANOUT 个,大V 不会拖慢计算。
+
+数组建好以后不再改。follow/unfollow 提交以后把变化记在一层小的增量(added/removed)里,
+查询的时候和 CSR 合在一起看;每 RECOMMEND_REBUILD_INTERVAL 秒后台线程从数据库完整重建一次,
+重建期间的变化在换上新图之前重放一遍,不会丢。别的进程里的关注要等下一次重建才会看到。
+增量发布出去以后不再原地修改,算推荐的时候直接拿来用,不用复制;增量超过 RECOMMEND_MAX_DELTA 条边就提前重建。
+
+推荐不参与首页和个人主页的 ETag(见 app/conditional.py),浏览器手里的页面没有别的变化时推荐也不会更新。
+/stats/recommend 返回图的大小和占用的内存。
+"""
+import atexit
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from app import app, db
+from .database import read_query
+from .models import User, followers
+
+
+class FollowGraph(object):
+    def __init__(self, nodes=None, offsets=None, targets=None):
+        self.nodes = nodes if nodes is not None else array('i')
+        self.offsets = offsets if offsets is not None else array('i', [0])
+        self.targets = targets if targets is not None else array('i')
+        # 建好以后的增量: follower_id -> frozenset(followed_id),改的时候复制一份改完整个换掉,见 snapshot
+        self.added = {}
+        self.removed = {}
+        self.delta_edges = 0
+        self.updates = 0
+        self.built_at = time.time()
+        self.build_seconds = 0.0
+
+    @classmethod
+    def load(cls, batch_size=10000):
+        """
+        按 (follower_id, followed_id) 的顺序流式读 followers 表,走唯一索引,不用在内存里排序。
+        自己关注自己的边不存
+        """
+        started = time.time()
+        graph = cls()
+        nodes, offsets, targets = graph.nodes, graph.offsets, graph.targets
+        query = db.session.query(followers.c.follower_id, followers.c.followed_id)\
+                          .order_by(followers.c.follower_id, followers.c.followed_id)\
+                          .yield_per(batch_size)
+        last = None
+        for follower_id, followed_id in query:
+            if follower_id == followed_id:
+                continue
+            if follower_id != last:
+                if last is not None:
+                    offsets.append(len(targets))
+                nodes.append(follower_id)
+                last = follower_id
+            targets.append(followed_id)
+        if last is not None:
+            offsets.append(len(targets))
+        graph.build_seconds = time.time() - started
+        return graph
+
+    def _base(self, user_id):
+        i = bisect_left(self.nodes, user_id)
+        if i < len(self.nodes) and self.nodes[i] == user_id:
+            return self.targets[self.offsets[i]:self.offsets[i + 1]]
+        return array('i')
+
+    def _in_base(self, follower_id, followed_id):
+        base = self._base(follower_id)
+        i = bisect_left(base, followed_id)
+        return i < len(base) and base[i] == followed_id
+
+    def following(self, user_id):
+        """
+        user_id 关注的人(不包括自己),合上增量
+        """
+        result = self._base(user_id)
+        removed = self.removed.get(user_id)
+        if removed:
+            result = [followed_id for followed_id in result if followed_id not in removed]
+        added = self.added.get(user_id)
+        if added:
+            result = list(result) + list(added)
+        return result
+
+    def apply(self, follower_id, followed_id, following):
+        """
+        记下一次 follow (following=True) 或 unfollow。重复记同一个变化没有影响
+        """
+        if follower_id == followed_id:
+            return
+        self.updates += 1
+        # 原来就有的边,unfollow 记进 removed,再 follow 回来就从 removed 里去掉;原来没有的边反过来
+        if self._in_base(follower_id, followed_id):
+            name, following = 'removed', not following
+        else:
+            name = 'added'
+        ids = getattr(self, name).get(follower_id, frozenset())
+        if following == (followed_id in ids):
+            return
+        delta = dict(getattr(self, name))
+        if following:
+            delta[follower_id] = ids | {followed_id}
+            self.delta_edges += 1
+        else:
+            ids = ids - {followed_id}
+            if ids:
+                delta[follower_id] = ids
+            else:
+                del delta[follower_id]
+            self.delta_edges -= 1
+        setattr(self, name, delta)
+
+    def snapshot(self):
+        """
+        和这个图共用 CSR 数组和当前这一版增量的副本,之后的 apply 不会影响它,可以在锁外面慢慢算。
+        apply 不原地修改增量,这里不用复制
+        """
+        graph = FollowGraph(self.nodes, self.offsets, self.targets)
+        graph.added, graph.removed = self.added, self.removed
+        return graph
+
+    def suggest(self, user_id, limit, max_fanout=None):
+        """
+        返回 [(user_id, 共同关注的人数), ...],人数多的在前,一样多的 id 小的在前
+        """
+        direct = self.following(user_id)
+        scores = Counter()
+        for followed_id in direct:
+            candidates = self.following(followed_id)
+            if max_fanout is not None and len(candidates) > max_fanout:
+                candidates = candidates[:max_fanout]
+            scores.update(candidates)
+        scores.pop(user_id, None)
+        for followed_id in direct:
+            scores.pop(followed_id, None)
+        return heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def memory(self):
+        arrays = (self.nodes, self.offsets, self.targets)
+        return {'users': len(self.nodes),
+                'edges': len(self.targets),
+                'csr_bytes': sum(a.itemsize * len(a) for a in arrays),
+                'added_edges': sum(len(ids) for ids in self.added.values()),
+                'removed_edges': sum(len(ids) for ids in self.removed.values()),
+                'updates': self.updates,
+                'age_seconds': time.time() - self.built_at,
+                'build_seconds': self.build_seconds}
+
+
+class Recommender(object):
+    """
+    进程里当前的 FollowGraph,以及定期重建它的后台线程
+    """
+    def __init__(self):
+        self.graph = None
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._replay = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    def rebuild(self):
+        """
+        在调用者的 app context 里从数据库重建。请求里不能再套一层 app context,
+        退出的时候会把请求的 scoped session 也删掉
+        """
+        with self._lock:
+            self._replay = []
+        try:
+            graph = FollowGraph.load(app.config['RECOMMEND_BATCH_SIZE'])
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            for change in self._replay:
+                graph.apply(*change)
+            self._replay = None
+            self.graph = graph
+        self.rebuilds += 1
+        app.logger.info('follow graph rebuilt: {}'.format(graph.memory()))
+        return graph
+
+    def changed(self, follower_id, ids, following):
+        """
+        关注关系提交以后调用
+        """
+        with self._lock:
+            for followed_id in ids:
+                if self.graph is not None:
+                    self.graph.apply(follower_id, followed_id, following)
+                if self._replay is not None:
+                    self._replay.append((follower_id, followed_id, following))
+            if self.graph is not None and self.graph.delta_edges > app.config['RECOMMEND_MAX_DELTA']:
+                # 增量太大了,提前重建: 有后台线程就叫醒它,没有就扔掉这张图,下一次用的时候重建
+                if self._thread is not None:
+                    self._wakeup.set()
+                else:
+                    self.graph = None
+
+    def suggest(self, user_id, limit=None):
+        if not app.config['RECOMMEND']:
+            return []
+        if app.config['RECOMMEND_REBUILD_INTERVAL']:
+            # 第一次由后台线程建图,建好之前没有推荐
+            self.start()
+            if self.graph is None:
+                return []
+        elif self.graph is None:
+            self.rebuild()
+        # 只在锁里拍个快照,二度关系在锁外面数,不挡住 follow/unfollow 提交以后的 changed()
+        with self._lock:
+            graph = self.graph.snapshot()
+        return graph.suggest(user_id, limit or app.config['RECOMMEND_LIMIT'],
+                             app.config['RECOMMEND_MAX_FANOUT'])
+
+    def reset(self):
+        with self._lock:
+            self.graph = None
+
+    def stats(self):
+        graph = self.graph
+        stats = graph.memory() if graph is not None else {}
+        stats['rebuilds'] = self.rebuilds
+        return stats
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='follow-graph-rebuilder')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        thread = self._thread
+        if thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping:
+            if self.graph is not None:
+                self._wakeup.wait(app.config['RECOMMEND_REBUILD_INTERVAL'])
+                self._wakeup.clear()
+                if self._stopping:
+                    break
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                app.logger.exception('follow graph rebuild failed')
+                if self.graph is None:
+                    self._wakeup.wait(app.config['RECOMMEND_REBUILD_INTERVAL'])
+
+
+recommender = Recommender()
+atexit.register(recommender.stop)
+
+
+def who_to_follow(user, limit=None):
+    """
+    给 user 推荐的用户,返回 [(User, 共同关注的人数), ...]。用户对象一条 IN 查询取回来
+    """
+    suggestions = recommender.suggest(user.id, limit)
+    if not suggestions:
+        return []
+    users = dict((u.id, u) for u in read_query(User).filter(User.id.in_([i for i, _ in suggestions])))
+    return [(users[i], score) for i, score in suggestions if i in users]
@@ -0,0 +1,220 @@
+"""
+Post 的全文搜索。
+
+SEARCH_ENGINE 选择搜索引擎:
+whoosh  whoosh 的磁盘倒排索引,放在 WHOOSH_BASE 目录下(flask-whooshalchemy 已经把 whoosh 带进来了)。
+        索引不在数据库事务里,所以在事务提交以后再更新。
+fts5    SQLite 的 FTS5 虚拟表 post_fts,rowid 就是 post id。和 post 在同一个事务里更新。
+None    关闭搜索。
+
+post 的新增、修改、删除在 flush 的时候收集起来,增量更新索引。
+全量重建用 db_reindex_search.py,按 id 分批流式读取 post 表,不会一次把整张表读进内存。
+"""
+import os
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm.attributes import get_history
+from app import app, db
+from . import archive
+from .cache import on_commit
+from .models import Post, with_authors
+
+
+CREATE_POST_FTS = 'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)'
+
+# FTS5 表跟着 post 表一起由 db.create_all() / db.drop_all() 创建和删除
+event.listen(Post.__table__, 'after_create', DDL(CREATE_POST_FTS).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite'))
+
+
+class WhooshSearch(object):
+    transactional = False
+
+    def __init__(self, path):
+        # whoosh 是可选依赖,只有用到的时候才导入
+        from whoosh import index
+        from whoosh.fields import Schema, ID, TEXT
+        self.path = path
+        self.schema = Schema(id=ID(stored=True, unique=True), body=TEXT)
+        if index.exists_in(path):
+            self.ix = index.open_dir(path)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.ix = index.create_in(path, self.schema)
+
+    def update(self, session, changes):
+        """
+        :param changes: {post id: body}, body 为 None 表示删除
+        """
+        from whoosh.writing import AsyncWriter
+        # AsyncWriter 在索引被别的进程锁住的时候会在后台线程里等锁,不会阻塞请求
+        writer = AsyncWriter(self.ix)
+        for post_id, body in changes.items():
+            if body is None:
+                writer.delete_by_term('id', str(post_id))
+            else:
+                writer.update_document(id=str(post_id), body=body)
+        writer.commit()
+
+    def search(self, query, page, per_page):
+        """
+        返回 (按相关度排好序的这一页 post id, 结果总数)
+        """
+        from whoosh.qparser import QueryParser
+        with self.ix.searcher() as searcher:
+            parsed = QueryParser('body', self.schema).parse(query)
+            results = searcher.search_page(parsed, page, pagelen=per_page)
+            if results.pagenum != page:
+                # 页码超出范围的时候 whoosh 会返回最后一页,这里和 FTS5 一样返回空的一页
+                return [], len(results)
+            return [int(hit['id']) for hit in results], len(results)
+
+    def reindex(self, batches):
+        from whoosh import index
+        self.ix = index.create_in(self.path, self.schema)
+        writer = self.ix.writer()
+        count = 0
+        for posts in batches:
+            for post in posts:
+                writer.add_document(id=str(post.id), body=post.body or '')
+            count += len(posts)
+        writer.commit()
+        return count
+
+
+class FTS5Search(object):
+    transactional = True
+
+    def __init__(self):
+        self._created = False
+
+    def _create(self, session):
+        # 老的数据库里可能还没有这张表,第一次用的时候在当前事务里建
+        if not self._created:
+            session.execute(text(CREATE_POST_FTS))
+            self._created = True
+
+    def update(self, session, changes):
+        self._create(session)
+        ids = [{'id': post_id} for post_id in changes]
+        session.execute(text('DELETE FROM post_fts WHERE rowid = :id'), ids)
+        rows = [{'id': post_id, 'body': body} for post_id, body in changes.items() if body is not None]
+        if rows:
+            session.execute(text('INSERT INTO post_fts (rowid, body) VALUES (:id, :body)'), rows)
+
+    def search(self, query, page, per_page):
+        # 把用户输入当作一个短语,避免 FTS5 查询语法出错
+        query = '"{}"'.format(query.replace('"', '""'))
+        self._create(db.session)
+        total = db.session.execute(text('SELECT count(*) FROM post_fts WHERE post_fts MATCH :q'),
+                                   {'q': query}).scalar()
+        rows = db.session.execute(text('SELECT rowid FROM post_fts WHERE post_fts MATCH :q '
+                                       'ORDER BY rank LIMIT :limit OFFSET :offset'),
+                                  {'q': query, 'limit': per_page, 'offset': (page - 1) * per_page})
+        return [row[0] for row in rows], total
+
+    def reindex(self, batches):
+        self._create(db.session)
+        db.session.execute(text('DELETE FROM post_fts'))
+        count = 0
+        for posts in batches:
+            self.update(db.session, dict((post.id, post.body or '') for post in posts))
+            db.session.commit()
+            count += len(posts)
+        return count
+
+
+class SearchResults(object):
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page * self.per_page < self.total
+
+
+_engines = {}
+
+
+def get_engine(name=None):
+    """
+    按名字(默认是 SEARCH_ENGINE 配置)创建并缓存搜索引擎,关闭搜索的时候返回 None
+    """
+    name = name or app.config.get('SEARCH_ENGINE')
+    if not name:
+        return None
+    if name not in _engines:
+        if name == 'whoosh':
+            _engines[name] = WhooshSearch(app.config['WHOOSH_BASE'])
+        elif name == 'fts5':
+            _engines[name] = FTS5Search()
+        else:
+            raise ValueError('Unknown SEARCH_ENGINE: {}'.format(name))
+    return _engines[name]
+
+
+def search(query, page=1, per_page=20):
+    """
+    搜索 post,返回 SearchResults,items 按相关度排序
+    """
+    ids, total = get_engine().search(query, page, per_page)
+    posts = dict((post.id, post) for post in with_authors(Post.query.filter(Post.id.in_(ids)))) if ids else {}
+    missing = [post_id for post_id in ids if post_id not in posts]
+    if missing and app.config['POST_ARCHIVE']:
+        # 已经归档的 post 还在索引里,到归档表里去找
+        posts.update(archive.find_posts(missing))
+    items = [posts[post_id] for post_id in ids if post_id in posts]
+    return SearchResults(items, page, per_page, total)
+
+
+def iter_posts(batch_size=1000):
+    """
+    按 id 分批流式读取所有 post 的 (id, body),归档表里的也算。只查这两列,结果不进 session 的 identity map,
+    每次只有一批在内存里
+    """
+    for table in [Post.__table__] + archive.archive_tables():
+        last_id = 0
+        while True:
+            posts = db.session.query(table.c.id, table.c.body)\
+                              .filter(table.c.id > last_id)\
+                              .order_by(table.c.id)\
+                              .limit(batch_size)\
+                              .all()
+            if not posts:
+                break
+            yield posts
+            last_id = posts[-1].id
+
+
+def reindex(name=None, batch_size=1000):
+    return get_engine(name).reindex(iter_posts(batch_size))
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_post_changes(session, flush_context):
+    engine = get_engine()
+    if engine is None:
+        return
+    changes = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            changes[obj.id] = obj.body or ''
+    for obj in session.dirty:
+        if isinstance(obj, Post) and get_history(obj, 'body').has_changes():
+            changes[obj.id] = obj.body or ''
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes[obj.id] = None
+    if not changes:
+        return
+    if engine.transactional:
+        engine.update(session, changes)
+    else:
+        on_commit(session, lambda: engine.update(None, changes))
@@ -0,0 +1,222 @@
+"""
+首页时间线的存储后端。
+
+User.followed_posts() 不再自己拼查询,而是交给这里由 TIMELINE_BACKEND 选出来的后端:
+
+join   原来的做法,读的时候把 followers 和 post 连接起来再按时间整体排序,写的时候什么都不做。
+fanout 写扩散。每条新 post 在 flush 的时候用一条 INSERT ... SELECT 写进所有粉丝的 timeline 表,
+       读首页就只是 (user_id, timestamp, post_id) 索引上的一次范围扫描。
+       粉丝数超过 TIMELINE_FANOUT_THRESHOLD 的作者("大V")不扇出,
+       他们的 post 在读的时候再合并进来(混合模式),免得一条 post 写上百万行。
+       扇没扇出是发 post 的时候决定的,记在 Post.fanned_out 上,读的时候只看这个标记,
+       不看作者现在的粉丝数:作者掉出或者进入大V 名单、各个进程的名单不一致,都不会漏掉 post。
+
+已有的数据或者改了阈值之后,用 db_rebuild_timeline.py 重建。
+"""
+import time
+from sqlalchemy import event, literal
+from app import app, db
+from . import archive
+from .models import User, Post, followers, timeline, with_authors
+from .pagination import paginate
+
+
+class JoinTimeline(object):
+    """
+    读时连接,不维护任何额外的数据
+    """
+    def branches(self, user):
+        """
+        组成时间线的各个查询,每个分支是 (未排序的查询, 时间列, id 列)。
+        分页的时候每个分支单独按自己的索引取一页,再在内存里归并,见 app/pagination.py
+        """
+        q = Post.query.join(followers, (followers.c.followed_id == Post.user_id))\
+                      .filter(followers.c.follower_id == user.id)
+        return [(q, Post.timestamp, Post.id)]
+
+    def posts(self, user, loading=None):
+        branches = self.branches(user)
+        if len(branches) == 1:
+            q, timestamp, ident = branches[0]
+            return with_authors(q, loading).order_by(timestamp.desc(), ident.desc())
+        q = branches[0][0].union(*[branch[0] for branch in branches[1:]])
+        return with_authors(q, loading).order_by(Post.timestamp.desc(), Post.id.desc())
+
+    def page(self, user, per_page, after=None, before=None, loading=None):
+        branches = [(with_authors(q, loading), timestamp, ident)
+                    for q, timestamp, ident in self.branches(user)]
+        # 翻过了热数据以后接着查归档表,见 app/archive.py
+        return paginate(branches, per_page, after=after, before=before,
+                        archives=archive.timeline_tiers(user, loading))
+
+    def decide(self, posts):
+        pass
+
+    def push(self, session, posts):
+        pass
+
+    def follow(self, user, followed):
+        self.follow_many(user, [followed.id])
+
+    def unfollow(self, user, followed):
+        self.unfollow_many(user, [followed.id])
+
+    def follow_many(self, user, ids):
+        pass
+
+    def unfollow_many(self, user, ids):
+        pass
+
+    def rebuild(self, batch_size=500):
+        return 0
+
+
+class FanoutTimeline(JoinTimeline):
+    """
+    写扩散的时间线, threshold 为 None 时所有作者都扇出
+    """
+    def __init__(self, threshold=None, backfill=100, celebrity_ttl=60):
+        self.threshold = threshold
+        self.backfill = backfill
+        self.celebrity_ttl = celebrity_ttl
+        self._celebrities = None
+        self._celebrities_at = 0
+
+    def celebrities(self):
+        """
+        粉丝数超过阈值的作者 id,走 User.follower_count 上的索引。
+        这个集合很小,在进程里缓存 celebrity_ttl 秒。只在写的时候用,过期一点只是让个别 post 多扇出或者少扇出
+        """
+        if self.threshold is None:
+            return frozenset()
+        now = time.time()
+        if self._celebrities is None or now - self._celebrities_at > self.celebrity_ttl:
+            rows = db.session.query(User.id).filter(User.follower_count > self.threshold)
+            self._celebrities = frozenset(row[0] for row in rows)
+            self._celebrities_at = now
+        return self._celebrities
+
+    def branches(self, user):
+        q = Post.query.join(timeline, timeline.c.post_id == Post.id)\
+                      .filter(timeline.c.user_id == user.id)
+        # 关注的人没有扇出的 post 读的时候合并,每个作者是 ix_post_user_fanned_out 上的一次范围扫描
+        pulled = Post.query.join(followers, (followers.c.followed_id == Post.user_id))\
+                           .filter(followers.c.follower_id == user.id)\
+                           .filter(Post.fanned_out.is_(False))
+        return [(q, timeline.c.timestamp, timeline.c.post_id), (pulled, Post.timestamp, Post.id)]
+
+    def decide(self, posts):
+        """
+        新 post 写进数据库之前决定要不要扇出。用 author=... 创建的 post 这时候还没有 user_id
+        """
+        celebrities = self.celebrities()
+        for post in posts:
+            user_id = post.user_id
+            if user_id is None and post.author is not None:
+                user_id = post.author.id
+            post.fanned_out = user_id not in celebrities
+
+    def push(self, session, posts):
+        for post in posts:
+            if not post.fanned_out:
+                continue
+            fans = session.query(followers.c.follower_id, literal(post.id), literal(post.timestamp))\
+                          .filter(followers.c.followed_id == post.user_id)\
+                          .distinct()
+            session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'],
+                                                          fans.statement))
+
+    def follow_many(self, user, ids):
+        """
+        新关注了一些人,把他们最近的 backfill 条 post 补进时间线。
+        一次关注很多人的时候首页也只看得到最新的一页,所以 backfill 是这些人合起来的条数。
+        没有扇出的 post 读的时候就合并进来了,不用补
+        """
+        if not ids:
+            return
+        existing = db.session.query(timeline.c.post_id).filter(timeline.c.user_id == user.id)
+        recent = db.session.query(literal(user.id), Post.id, Post.timestamp)\
+                           .filter(Post.user_id.in_(ids))\
+                           .filter(Post.fanned_out.is_(True))\
+                           .filter(~Post.id.in_(existing))\
+                           .order_by(Post.timestamp.desc())\
+                           .limit(self.backfill)
+        db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'],
+                                                         recent.statement))
+
+    def unfollow_many(self, user, ids):
+        authored = db.session.query(Post.id).filter(Post.user_id.in_(ids))
+        db.session.execute(timeline.delete()
+                                   .where(timeline.c.user_id == user.id)
+                                   .where(timeline.c.post_id.in_(authored)))
+
+    def rebuild(self, batch_size=500):
+        """
+        按现在的阈值重新决定每条 post 扇不扇出,再按用户 id 分批重建所有人的时间线,每批一个事务。
+        返回处理的用户数。
+        """
+        self._celebrities = None
+        celebrities = self.celebrities()
+        fanned_out = ~Post.user_id.in_(celebrities) if celebrities else True
+        db.session.query(Post).update({Post.fanned_out: fanned_out}, synchronize_session=False)
+        db.session.commit()
+        count, last_id = 0, 0
+        while True:
+            ids = [row[0] for row in db.session.query(User.id)
+                                               .filter(User.id > last_id)
+                                               .order_by(User.id)
+                                               .limit(batch_size)]
+            if not ids:
+                break
+            db.session.execute(timeline.delete().where(timeline.c.user_id.in_(ids)))
+            rows = db.session.query(followers.c.follower_id, Post.id, Post.timestamp)\
+                             .join(Post, Post.user_id == followers.c.followed_id)\
+                             .filter(followers.c.follower_id.in_(ids))\
+                             .filter(Post.fanned_out.is_(True))
+            db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'],
+                                                             rows.distinct().statement))
+            db.session.commit()
+            count += len(ids)
+            last_id = ids[-1]
+        return count
+
+
+_backend = (None, None)
+
+
+def get_backend():
+    """
+    按照配置创建(并缓存)时间线后端,配置变了会重新创建
+    """
+    global _backend
+    key = (app.config.get('TIMELINE_BACKEND', 'fanout'),
+           app.config.get('TIMELINE_FANOUT_THRESHOLD'),
+           app.config.get('TIMELINE_FOLLOW_BACKFILL', 100),
+           app.config.get('TIMELINE_CELEBRITY_TTL', 60))
+    if _backend[0] != key:
+        name, threshold, backfill, celebrity_ttl = key
+        if name == 'join':
+            backend = JoinTimeline()
+        elif name == 'fanout':
+            backend = FanoutTimeline(threshold=threshold, backfill=backfill, celebrity_ttl=celebrity_ttl)
+        else:
+            raise ValueError('Unknown TIMELINE_BACKEND: {}'.format(name))
+        _backend = (key, backend)
+    return _backend[1]
+
+
+@event.listens_for(db.session, 'before_flush')
+def decide_new_posts(session, flush_context, instances):
+    posts = [obj for obj in session.new if isinstance(obj, Post)]
+    if posts:
+        get_backend().decide(posts)
+
+
+@event.listens_for(db.session, 'after_flush')
+def push_new_posts(session, flush_context):
+    """
+    新 post 在同一个事务里推送到粉丝的时间线, 事务回滚的话时间线也一起回滚
+    """
+    posts = [obj for obj in session.new if isinstance(obj, Post)]
+    if posts:
+        get_backend().push(session, posts)
@@ -1,34 +1,41 @@
-from flask import render_template, flash, redirect, session, url_for, request, g
+from flask import render_template, flash, redirect, session, url_for, request, g, abort, send_file, jsonify, \
+    make_response
 from flask_login import login_user, logout_user, current_user, login_required
 from app import app, lm, db, oid
-from .forms import LoginForm, EditForm
 from .models import User
+from .lastseen import tracker as last_seen_tracker
+from . import avatars, conditional, emails, follows, identity, profiling, ratelimit, recommend, search as post_search
+from .cache import cache_stats
+from .database import read_only, read_query
 from datetime import datetime
+from functools import wraps
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 @app.route('/')
 @app.route('/index')
 @login_required
+@read_only
 def index():
     """
     login_required 装饰器确保了这页只被已经登录的用户看到。
+    时间线没有变化的时候直接返回 304,见 app/conditional.py
     """
     title = 'Hi there'
     user = g.user
-    posts = [
-        {
-            'author': {'nickname': 'John'},
-            'body': 'Beautiful day in Portland!'
-        },
-        {
-             'author': { 'nickname': 'Susan' },
-             'body': 'The Avengers movie was so cool!'
-        }
-    ]
-    return render_template('index.html',
-                           title=title,
-                           user=user,
-                           posts=posts)
+    validators = conditional.timeline_validators(user)
+    if conditional.is_fresh(validators):
+        return conditional.not_modified(validators)
+    page = user.followed_posts_page(app.config['POSTS_PER_PAGE'],
+                                    after=request.args.get('after'),
+                                    before=request.args.get('before'))
+    return conditional.with_validators(make_response(render_template('index.html',
+                                                                     title=title,
+                                                                     user=user,
+                                                                     posts=page.items,
+                                                                     page=page,
+                                                                     suggestions=recommend.who_to_follow(user))),
+                                       validators)
 
 
 @lm.user_loader
@@ -40,11 +47,15 @@ def load_user(id):
     请注意在 Flask-Login 中的用户 ids 永远是 unicode 字符串，
     因此在我们把 id 发送给 Flask-SQLAlchemy 之前，把 id 转成整型是必须的，
     否则会报错！
+    USER_LOADER_CACHE 打开的时候返回的是缓存的快照(CachedUser),见 app/identity.py
     """
+    if app.config['USER_LOADER_CACHE']:
+        return identity.load_user(int(id), session.get('profile_version', 0))
     return User.query.get(int(id))
 
 
 @app.route('/login', methods = ['GET', 'POST'])
+@ratelimit.limit('RATELIMIT_LOGIN', by=('ip',))
 @oid.loginhandler
 def login():
     """
@@ -59,6 +70,8 @@ def login():
     """
     if g.user is not None and g.user.is_authenticated:
         return redirect(url_for('index'))
+    # WTForms 只有登录和编辑资料的页面用得到,用到的时候再导入
+    from .forms import LoginForm
     form = LoginForm()
     if form.validate_on_submit():
         session['remember_me'] = form.remember_me.data
@@ -82,13 +95,11 @@ def after_login(resp):
         nickname = resp.nickname
         if nickname is None or nickname == '':
             nickname = resp.email.split('@')[0]
-        nickname = User.make_unique_nickname(nickname)
-        user = User(nickname=nickname, email=resp.email)
-        db.session.add(user)
-        db.session.commit()
+        user = User.register(nickname, resp.email)
         # make the user follow him/herself
         db.session.add(user.follow(user))
         db.session.commit()
+    session['profile_version'] = user.profile_version or 0
     remember_me = False
     if 'remember_me' in session:
         remember_me = session['remember_me']
@@ -109,44 +120,157 @@ def before_request():
     有了这个，所有请求将会访问到登录用户，即使在模版里。
     """
     g.user = current_user
-    if g.user.is_authenticated():
+    if g.user.is_authenticated:
         # 更新最近访问时间
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        now = datetime.utcnow()
+        if app.config['LAST_SEEN_WRITE_BEHIND']:
+            # 只记在内存里,由后台线程批量写回,见 app/lastseen.py。
+            # 这里用 set_committed_value 更新内存里的对象,不会把它标记成脏数据
+            last_seen_tracker.touch(g.user.id, now)
+            user = g.user._get_current_object()
+            if isinstance(user, User):
+                set_committed_value(user, 'last_seen', now)
+        else:
+            # g.user 可能是 CachedUser,赋值的时候会加载 session 里的 User 对象,不用再 add
+            g.user.last_seen = now
+            db.session.commit()
 
 
 @app.route('/logout')
 def logout():
     logout_user()
+    session.pop('profile_version', None)
     return redirect(url_for('index'))
 
 
 @app.route('/user/<nickname>')
 @login_required
+@read_only
 def user(nickname):
-    u = User.query.filter_by(nickname=nickname).first()
+    u = read_query(User).filter_by(nickname=nickname).first()
     if u is None:
         flash('User' + nickname + ' not found')
         return redirect(url_for('index'))
-    posts = {
-        {'author': u, 'body': 'Test post #1'},
-        {'author': u, 'body': 'Test post #2'}
-    }
-    return render_template('user.html',
-                           user=u,
-                           posts=posts)
+    validators = conditional.profile_validators(u, g.user)
+    if conditional.is_fresh(validators):
+        return conditional.not_modified(validators)
+    page = u.posts_page(app.config['POSTS_PER_PAGE'],
+                        after=request.args.get('after'),
+                        before=request.args.get('before'))
+    return conditional.with_validators(make_response(render_template('user.html',
+                                                                     user=u,
+                                                                     posts=page.items,
+                                                                     page=page,
+                                                                     suggestions=recommend.who_to_follow(g.user))),
+                                       validators)
+
+
+@app.route('/search')
+@login_required
+def search():
+    """
+    全文搜索 post,结果按相关度排序,按页码分页。搜索引擎由 SEARCH_ENGINE 配置,见 app/search.py
+    """
+    if post_search.get_engine() is None:
+        abort(404)
+    query = request.args.get('q', '').strip()
+    if not query:
+        return redirect(url_for('index'))
+    page = max(request.args.get('page', 1, type=int), 1)
+    results = post_search.search(query, page, app.config['SEARCH_RESULTS_PER_PAGE'])
+    return render_template('search.html',
+                           title='Search',
+                           query=query,
+                           results=results,
+                           posts=results.items)
+
+
+def stats_only(f):
+    """
+    /stats/* 运维接口只在 STATS_ENABLED 打开的时候可以访问,否则返回 404
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not app.config['STATS_ENABLED']:
+            abort(404)
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.route('/stats/cache')
+@stats_only
+@login_required
+def stats_cache():
+    return jsonify(cache_stats())
+
+
+@app.route('/stats/requests')
+@stats_only
+@login_required
+def stats_requests():
+    """
+    PROFILING 打开以后按路由汇总的耗时和 SQL 条数,见 app/profiling.py
+    """
+    return jsonify(profiling.request_stats())
+
+
+@app.route('/stats/recommend')
+@stats_only
+@login_required
+def stats_recommend():
+    """
+    内存里的关注图有多大,见 app/recommend.py
+    """
+    return jsonify(recommend.recommender.stats())
+
+
+@app.route('/stats/ratelimit')
+@stats_only
+@login_required
+def stats_ratelimit():
+    return jsonify(ratelimit.stats())
+
+
+@app.route('/stats/lastseen')
+@stats_only
+@login_required
+def stats_lastseen():
+    """
+    last_seen 写回缓冲省掉了多少次 commit,见 app/lastseen.py
+    """
+    return jsonify(last_seen_tracker.stats())
+
+
+@app.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    """
+    AVATAR_LOCAL 模式下的头像,从本地磁盘缓存里读,见 app/avatars.py
+    """
+    if not avatars.valid_request(digest, size):
+        abort(404)
+    path = avatars.local_avatar(digest, size)
+    if path is None:
+        return redirect(avatars.gravatar_url(digest, size))
+    response = send_file(path, mimetype='image/jpeg')
+    # 文件名里有邮箱的哈希和尺寸,内容不会变,让浏览器缓存得久一点
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['AVATAR_MAX_AGE']
+    return response
 
 
 @app.route('/edit', methods=['GET', 'POST'])
 @login_required
 def edit():
+    from .forms import EditForm
     form = EditForm(g.user.nickname)
     if form.validate_on_submit():
+        # 给 g.user 赋值的时候才会加载完整的 User 对象,它已经在 session 里了
         g.user.nickname = form.nickname.data
         g.user.about_me = form.about_me.data
-        db.session.add(g.user)
+        version = identity.profile_changed(g.user)
         db.session.commit()
+        session['profile_version'] = version
         flash('Your changes have been saved')
         return redirect(url_for('edit'))
     else:
@@ -173,6 +297,7 @@ def internal_error(error):
 
 
 @app.route('/follow/<nickname>')
+@ratelimit.limit('RATELIMIT_FOLLOW')
 @login_required
 def follow(nickname):
     user = User.query.filter_by(nickname=nickname).first()
@@ -182,17 +307,25 @@ def follow(nickname):
     if user == g.user:
         flash('You can not follow yourself!')
         return redirect(url_for('user', nickname=nickname))
-    u = g.user.followed(user)
+    u = g.user.follow(user)
     if u is None:
         flash('Cannot follow ' + nickname + '.')
         return redirect(url_for('user', nickname=nickname))
     db.session.add(u)
+    if app.config['FOLLOWER_EMAILS']:
+        # 邮件由后台 worker 发,和关注关系一起提交,见 app/jobs.py
+        emails.follower_notification.delay(user.id, g.user.id,
+                                           url_for('user', nickname=g.user.nickname, _external=True))
+    # 登录用户的快照里有关注数,换一个版本
+    version = identity.profile_changed(g.user)
     db.session.commit()
+    session['profile_version'] = version
     flash('You are now following ' + nickname + '!')
     return redirect(url_for('user', nickname=nickname))
 
 
 @app.route('/unfollow/<nickname>')
+@ratelimit.limit('RATELIMIT_FOLLOW')
 @login_required
 def unfollow(nickname):
     user = User.query.filter_by(nickname=nickname).first()
@@ -207,6 +340,33 @@ def unfollow(nickname):
         flash('Cannot unfollow ' + nickname + '.')
         return redirect(url_for('user', nickname=nickname))
     db.session.add(u)
+    version = identity.profile_changed(g.user)
     db.session.commit()
+    session['profile_version'] = version
     flash('You have stopped following ' + nickname + '.')
-    return redirect(url_for('user', nickname=nickname))
\ No newline at end of file
+    return redirect(url_for('user', nickname=nickname))
+
+
+@app.route('/follow/import', methods=['POST'])
+@ratelimit.limit('RATELIMIT_FOLLOW_IMPORT')
+@login_required
+def follow_import():
+    """
+    批量关注/取消关注,上传 JSON 或 CSV 格式的昵称列表,返回每一批的处理数目和耗时。见 app/follows.py
+    """
+    try:
+        to_follow, to_unfollow = follows.parse_import(request)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if len(to_follow) + len(to_unfollow) > app.config['FOLLOW_IMPORT_MAX']:
+        return jsonify(error='at most {} nicknames per import'.format(app.config['FOLLOW_IMPORT_MAX'])), 413
+    follow_ids, missing = follows.resolve_nicknames(to_follow)
+    unfollow_ids, unfollow_missing = follows.resolve_nicknames(to_unfollow)
+    followed = g.user.follow_many(follow_ids)
+    unfollowed = g.user.unfollow_many(unfollow_ids)
+    if followed.changed or unfollowed.changed:
+        session['profile_version'] = identity.profile_changed(g.user)
+    db.session.commit()
+    return jsonify(follow=followed.to_dict(),
+                   unfollow=unfollowed.to_dict(),
+                   not_found=missing + unfollow_missing)
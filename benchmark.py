@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+Web 接口的基准测试。
+
+先在一个单独的数据库文件里生成合成数据(N 个用户、幂律分布的关注关系、M 条 post,全部用批量 INSERT 写入),
+然后用 app.test_client() 以随机的登录用户反复请求 /index、/user/<nickname>、/follow/<nickname>、/edit,
+记录每个接口的延迟分位数和每个请求的 SQL 条数,结果写成 JSON,可以和别的提交的结果比较:
+
+    python benchmark.py --users 2000 --posts 50000 --output before.json
+    python benchmark.py --reuse --output after.json --compare before.json
+    python benchmark.py --set TIMELINE_BACKEND='join' --reuse
+
+数据库默认是 tmp/benchmark.db,--reuse 表示不重新生成数据。
+
+--workers 1,2,4,8 测的是多进程服务(serve.py)的吞吐量: 依次用这么多个 worker 启动 serve.py,
+--clients 个客户端进程在 --duration 秒里不停地请求 /index 和 /user/<nickname>,
+记录每秒请求数、延迟分位数,以及 serve.py 统计的每个 worker 处理的请求数:
+
+    python benchmark.py --db app.db --reuse --workers 1,2,4,8
+"""
+import argparse
+import ast
+import bisect
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark the web endpoints.')
+parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'benchmark.db'))
+parser.add_argument('--reuse', action='store_true', help='reuse the generated database')
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--posts', type=int, default=20000)
+parser.add_argument('--follows', type=int, default=20, help='average number of users each user follows')
+parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                    help='override a config value, e.g. --set POST_AUTHOR_LOADING=\'joined\'')
+parser.add_argument('--output', help='write the results to this JSON file')
+parser.add_argument('--compare', help='compare with the results in this JSON file')
+parser.add_argument('--workers', help='measure serve.py throughput with these worker counts, e.g. 1,2,4,8')
+parser.add_argument('--clients', type=int, default=16, help='concurrent client processes for --workers')
+parser.add_argument('--duration', type=float, default=10, help='seconds per worker count for --workers')
+options = parser.parse_args()
+
+# config.py 在导入的时候读 DATABASE_URL,所以要在导入 app 之前设置
+if not os.path.isdir(os.path.dirname(options.db)):
+    os.makedirs(os.path.dirname(options.db))
+if not options.reuse and os.path.exists(options.db):
+    os.remove(options.db)
+os.environ['DATABASE_URL'] = 'sqlite:///' + options.db
+
+from sqlalchemy import event
+from app import app, db
+from app.avatars import email_digest
+from app.counters import reconcile_counters
+from app.models import User, Post, followers
+from app.timeline import get_backend
+
+app.config['WTF_CSRF_ENABLED'] = False
+# 关注时的通知邮件留在队列里,不要让后台线程影响测量
+app.config['JOB_WORKERS'] = 0
+# 所有请求都来自同一个地址,不限流
+app.config['RATELIMIT'] = False
+for item in options.set:
+    key, _, value = item.partition('=')
+    app.config[key] = ast.literal_eval(value)
+
+
+def power_law_weights(n, alpha=1.2):
+    """
+    第 i 个用户被关注的权重正比于 1 / (i + 1)^alpha,少数人有大量粉丝
+    """
+    total, cumulative = 0.0, []
+    for i in range(n):
+        total += 1.0 / (i + 1) ** alpha
+        cumulative.append(total)
+    return cumulative
+
+
+def weighted_choice(rng, cumulative):
+    return bisect.bisect_left(cumulative, rng.random() * cumulative[-1])
+
+
+def generate(users, posts, follows, rng, batch_size=5000):
+    """
+    用批量 INSERT 生成数据,不经过 ORM 的 flush 钩子,最后统一重算计数、重建时间线
+    """
+    user_rows = [{'id': i + 1,
+                  'nickname': 'user{}'.format(i + 1),
+                  'email': 'user{}@example.com'.format(i + 1),
+                  'email_hash': email_digest('user{}@example.com'.format(i + 1)),
+                  'about_me': 'I am user {}'.format(i + 1)} for i in range(users)]
+    db.session.execute(User.__table__.insert(), user_rows)
+
+    cumulative = power_law_weights(users)
+    edges = set()
+    for follower in range(1, users + 1):
+        edges.add((follower, follower))
+        # 关注数本身也是长尾的
+        count = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+        for _ in range(count):
+            edges.add((follower, weighted_choice(rng, cumulative) + 1))
+    edges = [{'follower_id': a, 'followed_id': b} for a, b in edges]
+    for i in range(0, len(edges), batch_size):
+        db.session.execute(followers.insert(), edges[i:i + batch_size])
+
+    start = datetime.utcnow() - timedelta(days=365)
+    for i in range(0, posts, batch_size):
+        rows = [{'body': 'post #{} about nothing in particular'.format(j),
+                 'timestamp': start + timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                 'user_id': weighted_choice(rng, cumulative) + 1}
+                for j in range(i, min(posts, i + batch_size))]
+        db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+    reconcile_counters()
+    get_backend().rebuild()
+    return len(edges)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(latencies, queries, statuses):
+    return {'requests': len(latencies),
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000,
+            'queries_per_request': float(sum(queries)) / len(queries),
+            'max_queries': max(queries),
+            'statuses': dict((str(code), statuses.count(code)) for code in set(statuses))}
+
+
+def endpoints(rng, users):
+    """
+    每个接口返回 (请求的方法, URL, 表单数据) 的生成函数,参数是当前登录的用户 id
+    """
+    def nickname(user_id):
+        return 'user{}'.format(user_id)
+    return [
+        ('index', lambda me: ('GET', '/index', None)),
+        ('user', lambda me: ('GET', '/user/' + nickname(rng.randint(1, users)), None)),
+        ('follow', lambda me: ('GET', '/follow/' + nickname(rng.randint(1, users)), None)),
+        ('edit', lambda me: ('POST', '/edit', {'nickname': nickname(me),
+                                               'about_me': 'edited at {}'.format(time.time())})),
+    ]
+
+
+def run(engine, requests, users, rng):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    client = app.test_client()
+    results = {}
+    for name, make_request in endpoints(rng, users):
+        latencies, queries, statuses = [], [], []
+        for i in range(requests):
+            me = rng.randint(1, users)
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(me)
+                sess.pop('profile_version', None)
+            method, url, data = make_request(me)
+            del statements[:]
+            started = time.time()
+            response = client.open(url, method=method, data=data)
+            latencies.append(time.time() - started)
+            queries.append(len(statements))
+            statuses.append(response.status_code)
+        results[name] = summarize(latencies, queries, statuses)
+    event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def session_cookies(user_ids):
+    """
+    和登录以后浏览器拿到的一样的 session cookie,不用走 OpenID
+    """
+    serializer = app.session_interface.get_signing_serializer(app)
+    return ['{}={}'.format(app.config['SESSION_COOKIE_NAME'], serializer.dumps({'_user_id': str(user_id)}))
+            for user_id in user_ids]
+
+
+def client(args):
+    """
+    一个客户端进程: duration 秒里一个接一个地发请求,返回 (每个请求的延迟, 失败数)
+    """
+    port, cookies, paths, duration, seed = args
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', rng.choice(paths), headers={'Cookie': rng.choice(cookies)})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+        latencies.append(time.time() - started)
+    return latencies, errors
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/login')
+            if conn.getresponse().status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('serve.py did not start')
+
+
+def throughput(workers, clients, duration, users, rng):
+    """
+    用 workers 个进程启动 serve.py(和这里用同一个数据库,见 DATABASE_URL),测 duration 秒
+    """
+    stats_file = options.db + '.serve.json'
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+                               '--bind', '127.0.0.1:0', '--workers', str(workers), '--stats-file', stats_file],
+                              stdout=subprocess.PIPE)
+    try:
+        port = int(re.search(r':(\d+) with', server.stdout.readline().decode('utf-8')).group(1))
+        wait_ready(port)
+        # 等所有 worker 都 import 完
+        time.sleep(1)
+        cookies = session_cookies(rng.randint(1, users) for _ in range(100))
+        paths = ['/index'] + ['/user/user{}'.format(rng.randint(1, users)) for _ in range(100)]
+        pool = multiprocessing.get_context('fork').Pool(clients)
+        try:
+            samples = pool.map(client, [(port, cookies, paths, duration, rng.random()) for _ in range(clients)])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    latencies = [latency for sample, _ in samples for latency in sample]
+    with open(stats_file) as f:
+        served = json.load(f)
+    os.remove(stats_file)
+    per_worker = sorted(served['finished'].values())
+    return {'workers': workers,
+            'clients': clients,
+            'requests': len(latencies),
+            'errors': sum(errors for _, errors in samples),
+            'requests_per_second': len(latencies) / duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'per_worker': per_worker}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, served):
+    for workers, after in sorted(served.items(), key=lambda item: int(item[0])):
+        before = baseline.get('throughput', {}).get(workers)
+        if before is not None:
+            print('{} workers: {:.1f} -> {:.1f} requests/s ({:.2f}x)'.format(
+                workers, before['requests_per_second'], after['requests_per_second'],
+                after['requests_per_second'] / before['requests_per_second']))
+    if not results:
+        return
+    print('{:<8} {:>12} {:>12} {:>8} {:>10} {:>10}'.format('endpoint', 'p50 before', 'p50 after', 'ratio',
+                                                           'q before', 'q after'))
+    for name, after in sorted(results.items()):
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        ratio = after['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan')
+        print('{:<8} {:>10.2f}ms {:>10.2f}ms {:>7.2f}x {:>10.1f} {:>10.1f}'.format(
+            name, before['p50_ms'], after['p50_ms'], ratio,
+            before['queries_per_request'], after['queries_per_request']))
+
+
+with app.app_context():
+    rng = random.Random(options.seed)
+    if not options.reuse:
+        db.create_all()
+        started = time.time()
+        edges = generate(options.users, options.posts, options.follows, rng)
+        print('Generated {} users, {} follows and {} posts in {:.1f}s'.format(
+            options.users, edges, options.posts, time.time() - started))
+    users = db.session.query(User).count()
+    engine = db.engine
+    db.session.remove()
+if options.workers:
+    # 多进程服务的吞吐量,请求都通过 HTTP 发给 serve.py
+    results = {}
+    served = dict((str(n), throughput(n, options.clients, options.duration, users, rng))
+                  for n in map(int, options.workers.split(',')))
+else:
+    # 每个请求要有自己的 app context (g 里缓存着当前用户),所以在外面跑
+    results = run(engine, options.requests, users, rng)
+    served = {}
+
+report = {'commit': git_commit(),
+          'time': datetime.utcnow().isoformat(),
+          'python': sys.version.split()[0],
+          'users': users,
+          'requests': options.requests,
+          'overrides': options.set,
+          'endpoints': results,
+          'throughput': served}
+for name, result in sorted(results.items()):
+    print('{:<8} p50 {:7.2f}ms  p90 {:7.2f}ms  p99 {:7.2f}ms  {:5.1f} queries/request  {}'.format(
+        name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['queries_per_request'],
+        result['statuses']))
+for workers, result in sorted(served.items(), key=lambda item: int(item[0])):
+    print('{:>2} workers  {:8.1f} requests/s  p50 {:7.2f}ms  p99 {:7.2f}ms  {} errors  per worker {}'.format(
+        result['workers'], result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['errors'],
+        result['per_worker']))
+if options.output:
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+if options.compare:
+    with open(options.compare) as f:
+        compare(results, json.load(f), served)
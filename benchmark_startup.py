@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+启动时间的基准测试。
+
+每次开一个新的解释器执行 python -X importtime -c "import app",重复 --runs 次,记录:
+- 进程从启动到 import 完成的墙上时间;
+- importtime 报告里每个模块的 self / cumulative 时间(取中位数),列出最慢的几个;
+- 哪些只在少数请求里用到的模块(OpenID、邮件、表单)在 import 的时候就被导入了。
+
+结果写成 JSON,可以和别的提交的结果比较,和 benchmark.py 一样:
+
+    python benchmark_startup.py --output before.json
+    python benchmark_startup.py --output after.json --compare before.json
+    python benchmark_startup.py --module test      测试启动的时间
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description='Benchmark the import time of the app.')
+parser.add_argument('--module', action='append', default=[], help='module to import, default app')
+parser.add_argument('--runs', type=int, default=10)
+parser.add_argument('--top', type=int, default=15, help='number of slowest modules to show')
+parser.add_argument('--output', help='write the results to this JSON file')
+parser.add_argument('--compare', help='compare with the results in this JSON file')
+options = parser.parse_args()
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LAZY_MODULES = ['flask_openid', 'openid', 'flask_mail', 'wtforms', 'flask_wtf', 'whoosh']
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+SCRIPT = ('import sys, time\n'
+          'import {module}\n'
+          'sys.stdout.write(repr((time.time(), sorted(sys.modules))))\n')
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def import_once(module):
+    """
+    在新进程里 import 一次,返回 (墙上时间秒数, {模块: (self 微秒, cumulative 微秒)}, 导入了的模块名)
+    """
+    started = time.time()
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT.format(module=module)],
+                            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    finished, loaded = ast.literal_eval(output.stdout.decode('utf-8'))
+    times = {}
+    for line in output.stderr.decode('utf-8').splitlines():
+        match = LINE.match(line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return finished - started, times, loaded
+
+
+def measure(module, runs):
+    walls, samples, loaded = [], {}, set()
+    for _ in range(runs):
+        wall, times, modules = import_once(module)
+        walls.append(wall)
+        loaded.update(modules)
+        for name, sample in times.items():
+            samples.setdefault(name, []).append(sample)
+    modules = dict((name, {'self_ms': median([s for s, _ in values]) / 1000.0,
+                           'cumulative_ms': median([c for _, c in values]) / 1000.0})
+                   for name, values in samples.items())
+    return {'runs': runs,
+            'wall_ms': median(walls) * 1000,
+            'min_wall_ms': min(walls) * 1000,
+            'import_ms': modules.get(module, {}).get('cumulative_ms'),
+            'modules': len(modules),
+            'slowest': sorted(modules.items(), key=lambda item: item[1]['self_ms'], reverse=True)[:options.top],
+            'app_modules': dict((name, m['cumulative_ms']) for name, m in modules.items()
+                                if name == 'app' or name.startswith('app.')),
+            'eager': sorted(name for name in LAZY_MODULES if name in loaded)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print('{:<8} {:>14} {:>14} {:>8}'.format('module', 'wall before', 'wall after', 'ratio'))
+    for name, after in sorted(results.items()):
+        before = baseline['modules'].get(name)
+        if before is None:
+            continue
+        print('{:<8} {:>12.1f}ms {:>12.1f}ms {:>7.2f}x'.format(name, before['wall_ms'], after['wall_ms'],
+                                                             after['wall_ms'] / before['wall_ms']))
+
+
+results = dict((module, measure(module, options.runs)) for module in options.module or ['app'])
+for module, result in sorted(results.items()):
+    print('import {}: {:.1f}ms wall (min {:.1f}ms), {:.1f}ms in imports, {} modules'.format(
+        module, result['wall_ms'], result['min_wall_ms'], result['import_ms'] or 0, result['modules']))
+    print('  eagerly imported: {}'.format(', '.join(result['eager']) or 'none'))
+    for name, cumulative in sorted(result['app_modules'].items(), key=lambda item: item[1], reverse=True):
+        print('  {:<24} {:8.1f}ms cumulative'.format(name, cumulative))
+    print('  slowest modules (self time):')
+    for name, times in result['slowest']:
+        print('  {:<24} {:8.1f}ms'.format(name, times['self_ms']))
+
+report = {'commit': git_commit(),
+          'time': datetime.utcnow().isoformat(),
+          'python': sys.version.split()[0],
+          'modules': results}
+if options.output:
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+if options.compare:
+    with open(options.compare) as f:
+        compare(results, json.load(f))
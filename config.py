@@ -13,7 +13,27 @@ OPENID_PROVIDERS = [
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 # SQLALCHEMY_DATABASE_URI 是 Flask-SQLAlchemy 扩展需要的。这是我们数据库文件的路径。
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# 可以用环境变量 DATABASE_URL 换成别的数据库。
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
+
+# 只读副本,时间线和个人主页的只读查询会走这里,见 app/database.py。None 表示不用副本
+SQLALCHEMY_READ_URI = os.environ.get('DATABASE_READ_URL')
+
+# 各个环境的连接池参数,用环境变量 MICROBLOG_ENV 选择
+DATABASE_ENV = os.environ.get('MICROBLOG_ENV', 'development')
+DATABASE_ENVIRONMENTS = {
+    'development': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600},
+    'testing': {'pool_size': 1, 'max_overflow': 5, 'pool_recycle': 3600},
+    'production': {'pool_size': 20, 'max_overflow': 20, 'pool_recycle': 1800, 'pool_timeout': 10},
+}
+
+# SQLite 每个新连接都会执行的 PRAGMA
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
 
 # SQLALCHEMY_MIGRATE_REPO 是文件夹(作为迁移仓库)，我们将会把 SQLAlchemy-migrate 数据文件存储在这里。
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
@@ -28,3 +48,153 @@ MAIL_PASSWORD = None
 
 # administrator list
 ADMINS = ['you@example.com']
+
+# logging, 见 app/logs.py
+LOG_FILE = os.path.join(basedir, 'tmp', 'microblog.log')
+LOG_FILE_MAX_BYTES = 1 * 1024 * 1024
+LOG_FILE_BACKUPS = 10
+# True 表示日志文件每行是一个 JSON 对象
+LOG_JSON = False
+# 内存里最多排队的日志条数,满了丢掉最旧的
+LOG_QUEUE_SIZE = 10000
+# 错误邮件最多多久发一封,期间的错误合并到一封里
+LOG_MAIL_INTERVAL = 60
+# 一封错误邮件里最多的错误条数
+LOG_MAIL_BATCH = 100
+
+# background jobs, 见 app/jobs.py
+# web 进程里的 worker 线程数,0 表示只用 worker.py 单独跑
+JOB_WORKERS = 2
+# 队列空的时候多久看一次
+JOB_POLL_INTERVAL = 1.0
+JOB_MAX_ATTEMPTS = 5
+# 第 n 次重试前等 JOB_RETRY_DELAY * 2^(n-1) 秒
+JOB_RETRY_DELAY = 10
+# 领了任务超过这么多秒还没完成,认为 worker 挂了,放回队列
+JOB_TIMEOUT = 600
+
+# 有了新粉丝的时候发邮件通知
+FOLLOWER_EMAILS = True
+
+# pagination
+POSTS_PER_PAGE = 20
+# post archive, 见 app/archive.py
+# 打开以后翻页翻过了热数据会接着查归档表
+POST_ARCHIVE = True
+# db_archive_posts.py 把早于这么多天的 post 按月搬到归档表
+ARCHIVE_HORIZON_DAYS = 180
+# 已有的归档表名单在进程内缓存的秒数
+ARCHIVE_TABLES_TTL = 60
+# post 列表怎么加载作者: 'selectin'、'joined' 或 'lazy',见 app/models.py 里的 with_authors
+POST_AUTHOR_LOADING = 'selectin'
+
+# timeline settings, 见 app/timeline.py
+# TIMELINE_BACKEND: 'fanout' 写扩散到 timeline 表; 'join' 读的时候连接 followers 表
+TIMELINE_BACKEND = 'fanout'
+# 粉丝数超过这个值的作者不扇出,读首页的时候再合并他们的 post。None 表示全部扇出
+TIMELINE_FANOUT_THRESHOLD = 1000
+# 新关注一个人时补进时间线的 post 数
+TIMELINE_FOLLOW_BACKFILL = 100
+# 大V 名单在进程内缓存的秒数
+TIMELINE_CELEBRITY_TTL = 60
+
+# follow graph cache, 见 app/cache.py
+FOLLOW_CACHE_SIZE = 10000
+FOLLOW_CACHE_TTL = 300
+# 跨进程共享的缓存文件(shelve),None 表示只用进程内缓存
+FOLLOW_CACHE_SHARED = None
+
+# bulk follow / follow import, 见 app/follows.py
+# 每批处理的用户数,也是每条 IN (...) 的长度上限
+FOLLOW_BATCH_SIZE = 500
+# 一次导入最多的昵称数
+FOLLOW_IMPORT_MAX = 10000
+
+# who to follow, 见 app/recommend.py
+RECOMMEND = True
+# 首页和个人主页上推荐的人数
+RECOMMEND_LIMIT = 5
+# 算推荐的时候每个关注的人最多看他关注的这么多个
+RECOMMEND_MAX_FANOUT = 1000
+# 内存里的关注图多久从数据库完整重建一次(秒),0 表示不用后台线程,第一次用的时候在请求里建
+RECOMMEND_REBUILD_INTERVAL = 3600
+# 建图的时候每批从 followers 表读的行数
+RECOMMEND_BATCH_SIZE = 10000
+# 增量里的边超过这么多条就提前重建,不等 RECOMMEND_REBUILD_INTERVAL
+RECOMMEND_MAX_DELTA = 10000
+
+# rate limiting, 见 app/ratelimit.py
+RATELIMIT = True
+# 令牌桶的容量/时间: '30/minute' 表示最多连着 30 次,之后每 2 秒恢复一次。按用户和 IP 各一个桶
+RATELIMIT_FOLLOW = '30/minute'
+RATELIMIT_FOLLOW_IMPORT = '5/hour'
+# 登录只按 IP
+RATELIMIT_LOGIN = '10/minute'
+# 进程内最多记多少个桶,满了丢掉最久没用的
+RATELIMIT_MAX_KEYS = 100000
+# 多个进程共享令牌桶的 shelve 文件,比如 os.path.join(basedir, 'tmp', 'ratelimit'); None 表示每个进程各自计数
+RATELIMIT_SHARED = None
+
+# last_seen write-behind, 见 app/lastseen.py
+# False 表示像以前一样每个请求都 commit 一次
+LAST_SEEN_WRITE_BEHIND = True
+# 数据库里的 last_seen 最多落后这么多秒
+LAST_SEEN_FLUSH_INTERVAL = 30
+# 攒够这么多个用户就提前写回
+LAST_SEEN_FLUSH_SIZE = 500
+
+# user_loader cache, 见 app/identity.py
+USER_LOADER_CACHE = True
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+USER_CACHE_SHARED = None
+
+# avatars, 见 app/avatars.py
+# True 表示头像由本站 /avatar/<digest>/<size> 提供,第一次从 Gravatar 取回来以后缓存在 AVATAR_DIR
+AVATAR_LOCAL = False
+AVATAR_DIR = os.path.join(basedir, 'tmp', 'avatars')
+AVATAR_MAX_SIZE = 512
+AVATAR_FETCH_TIMEOUT = 5
+AVATAR_MAX_AGE = 30 * 24 * 3600
+# db_backfill_avatars.py 在 AVATAR_LOCAL 模式下预先取好的尺寸
+AVATAR_SIZES = (50, 128)
+
+# full text search, 见 app/search.py
+# 'whoosh' 磁盘倒排索引; 'fts5' SQLite FTS5 虚拟表; None 关闭搜索
+SEARCH_ENGINE = 'whoosh'
+WHOOSH_BASE = os.path.join(basedir, 'tmp', 'search.db')
+SEARCH_RESULTS_PER_PAGE = 20
+
+# rendered post fragment cache, 见 app/fragments.py
+FRAGMENT_CACHE = True
+# 条目数上限,每条是一段 post.html,最多几百字节
+FRAGMENT_CACHE_SIZE = 5000
+FRAGMENT_CACHE_TTL = 24 * 3600
+# 磁盘层,比如 os.path.join(basedir, 'tmp', 'fragments'); None 表示只用内存
+FRAGMENT_CACHE_SHARED = None
+
+# conditional GET and compression, 见 app/conditional.py
+# 首页和个人主页带 ETag / Last-Modified,没变的时候返回 304
+CONDITIONAL_GET = True
+# 按 Accept-Encoding 用 gzip 压缩响应
+COMPRESS = True
+COMPRESS_LEVEL = 6
+# 小于这么多字节的响应不压缩
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = ('text/html', 'application/json')
+
+# per-request profiling, 见 app/profiling.py
+# 打开以后每个响应带 Server-Timing 头,/stats/requests 可以看到按路由的统计
+PROFILING = False
+# 每个请求记下最慢的几条 SQL
+PROFILING_TOP_QUERIES = 5
+# 超过这么多毫秒的请求写日志
+PROFILING_SLOW_MS = 500
+# 慢请求写日志的比例
+PROFILING_LOG_SAMPLE = 1.0
+# 耗时直方图的分桶(毫秒)
+PROFILING_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# /stats/* 运维接口(缓存命中率、请求耗时、关注图、限流、last_seen),见 app/views.py
+# 关掉的时候返回 404,打开以后也要登录才能看,只在内网或者调试的时候打开
+STATS_ENABLED = False
@@ -0,0 +1,11 @@
+import sys
+from app import app
+from app.archive import archive_posts
+
+"""
+把早于 ARCHIVE_HORIZON_DAYS 天的 post 按月搬到归档表,见 app/archive.py。定期(比如每天)运行一次。
+python db_archive_posts.py        用配置的天数
+python db_archive_posts.py 30     早于 30 天的
+"""
+days = int(sys.argv[1]) if len(sys.argv) > 1 else app.config['ARCHIVE_HORIZON_DAYS']
+print('Archived', archive_posts(days), 'posts older than', days, 'days')
@@ -0,0 +1,24 @@
+from app import app, db
+from app.avatars import email_digest, local_avatar
+from app.models import User
+
+"""
+给老数据补上 User.email_hash(新用户在设置邮箱的时候自动算好)。
+如果打开了 AVATAR_LOCAL,顺便把 AVATAR_SIZES 里的各个尺寸预先取到本地。
+"""
+batch_size = 500
+count, last_id = 0, 0
+while True:
+    users = User.query.filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+    if not users:
+        break
+    for user in users:
+        if user.email and user.email_hash is None:
+            user.email_hash = email_digest(user.email)
+            count += 1
+        if app.config['AVATAR_LOCAL'] and user.email_hash:
+            for size in app.config['AVATAR_SIZES']:
+                local_avatar(user.email_hash, size)
+    db.session.commit()
+    last_id = users[-1].id
+print('Email hashes backfilled for', count, 'users')
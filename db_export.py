@@ -0,0 +1,17 @@
+import argparse
+from app.dataset import export_data, FORMATS
+
+"""
+把 user、post、followers 导出成可移植的 JSON lines 或 CSV 文件,见 app/dataset.py。
+
+    python db_export.py backup/ --format csv
+"""
+parser = argparse.ArgumentParser(description='Export users, posts and the follow graph.')
+parser.add_argument('directory')
+parser.add_argument('--format', choices=FORMATS, default='json')
+parser.add_argument('--batch-size', type=int, default=1000)
+options = parser.parse_args()
+
+counts = export_data(options.directory, options.format, options.batch_size)
+for table, count in sorted(counts.items()):
+    print('Exported', count, 'rows from', table)
@@ -0,0 +1,23 @@
+import argparse
+from app import app
+from app.dataset import import_data, FORMATS
+from app.search import get_engine, reindex
+from app.timeline import get_backend
+
+"""
+把 db_export.py 导出的文件导入到一个用 db_create.py 新建的空库,然后重建时间线和搜索索引。见 app/dataset.py。
+
+    python db_import.py backup/ --format csv
+"""
+parser = argparse.ArgumentParser(description='Import users, posts and the follow graph.')
+parser.add_argument('directory')
+parser.add_argument('--format', choices=FORMATS, default='json')
+parser.add_argument('--batch-size', type=int, default=1000)
+options = parser.parse_args()
+
+counts = import_data(options.directory, options.format, options.batch_size)
+for table, count in sorted(counts.items()):
+    print('Imported', count, 'rows into', table)
+print('Timelines rebuilt for', get_backend().rebuild(), 'users with backend', app.config['TIMELINE_BACKEND'])
+if get_engine() is not None:
+    print('Indexed', reindex(), 'posts with', app.config['SEARCH_ENGINE'])
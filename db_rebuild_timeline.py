@@ -0,0 +1,10 @@
+from app import app
+from app.timeline import get_backend
+
+"""
+重建所有用户的首页时间线(timeline 表)。
+第一次切换到 fanout 后端、修改 TIMELINE_FANOUT_THRESHOLD 之后,
+或者怀疑时间线和 followers 表不一致的时候运行一次。
+"""
+count = get_backend().rebuild()
+print('Timelines rebuilt for', count, 'users with backend', app.config['TIMELINE_BACKEND'])
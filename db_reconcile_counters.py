@@ -0,0 +1,8 @@
+from app.counters import reconcile_counters
+
+"""
+重算 User 上的 follower_count / followed_count / post_count。
+计数是在写的时候顺手维护的,直接改库或者导入老数据以后可能会不一致,运行一次即可修复。
+"""
+repaired = reconcile_counters()
+print('Counters repaired for', repaired, 'users')
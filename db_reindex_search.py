@@ -0,0 +1,14 @@
+import sys
+import time
+from app import app
+from app.search import reindex
+
+"""
+全量重建 post 的搜索索引。
+python db_reindex_search.py              重建 SEARCH_ENGINE 配置的索引
+python db_reindex_search.py whoosh fts5  依次重建多个引擎的索引,可以用来比较它们在我们的数据上的索引速度
+"""
+for name in sys.argv[1:] or [app.config['SEARCH_ENGINE']]:
+    start = time.time()
+    count = reindex(name)
+    print('{}: {} posts indexed in {:.2f}s'.format(name, count, time.time() - start))
@@ -1,3 +1,3 @@
-from app import app
+from app import create_app
 
-app.run(debug = True)
\ No newline at end of file
+create_app().run(debug = True)
\ No newline at end of file
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+多进程的生产服务入口。
+
+run.py 是 Flask 的开发服务器,只有一个进程,用不上多个核。这里的主进程先打开监听的 socket,
+再 fork 出 --workers 个 worker 进程,它们在同一个 socket 上 accept,由内核把连接分给空闲的进程。
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4
+
+- 每个 worker 在 fork 以后才 import app(--preload 的话在主进程里 import 一次,fork 出来的进程共享这部分内存),
+  然后调用 create_app() 和 database.after_fork(),用自己的连接池,不会和别的进程共用 SQLite 连接;
+- worker 意外退出的时候主进程会补一个新的;
+- kill -HUP <主进程> 平滑重启: 先起一组新的 worker(不用 --preload 的时候会加载新的代码),
+  再让旧的处理完手上的请求后退出,整个过程监听的 socket 一直开着,不会拒绝连接;
+- kill -TERM / Ctrl+C 平滑退出,worker 处理完手上的请求才退出;
+- 每个 worker 处理的请求数记在主进程建好的共享内存里,kill -USR1 <主进程> 打印出来,
+  退出的时候写到 --stats-file (JSON)。
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from multiprocessing.sharedctypes import RawArray
+
+parser = argparse.ArgumentParser(description='Serve the app with preforked worker processes.')
+parser.add_argument('--bind', default='127.0.0.1:8000', help='HOST:PORT, port 0 picks a free port')
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+parser.add_argument('--preload', action='store_true', help='import the app once in the master before forking')
+parser.add_argument('--access-log', action='store_true', help='log every request to stderr')
+parser.add_argument('--stats-file', help='write the per-worker request counts here on exit')
+options = parser.parse_args()
+
+# 正在重启的时候新旧两组 worker 同时存在
+SLOTS = options.workers * 2
+
+
+def listen(bind):
+    host, _, port = bind.rpartition(':')
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(128)
+    # 一个连接来了所有 worker 都会被唤醒,没抢到的 accept 直接返回,而不是一直阻塞在那里
+    sock.setblocking(False)
+    return sock
+
+
+def counting(wsgi_app, counters, slot):
+    """
+    记请求数的 WSGI 中间件。每个 worker 只写自己的那一格,不用加锁
+    """
+    def middleware(environ, start_response):
+        counters[slot] += 1
+        return wsgi_app(environ, start_response)
+    return middleware
+
+
+def run_worker(sock, slot, counters):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    # Ctrl+C 会发给整个进程组,由主进程统一安排退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import create_app, database, db
+    app = create_app()
+    database.after_fork(app, db)
+
+    class RequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            if options.access_log:
+                WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, counting(app, counters, slot),
+                         request_handler=RequestHandler, fd=sock.fileno())
+    server.timeout = 0.5
+    while not stopping:
+        server.handle_request()
+    server.server_close()
+
+
+class Arbiter(object):
+    def __init__(self, sock, workers):
+        self.sock = sock
+        self.workers = workers
+        self.counters = RawArray('l', SLOTS)
+        self.children = {}
+        self.retiring = set()
+        # 已经退出的 worker: pid -> 处理的请求数
+        self.finished = {}
+        self.signals = []
+
+    def spawn(self):
+        slot = min(set(range(SLOTS)) - set(self.children.values()))
+        self.counters[slot] = 0
+        # 不然缓冲区里还没写出去的内容子进程退出的时候会再写一遍
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            # 子进程: 处理完请求以后正常退出,让 atexit 里的清理(last_seen 写回、日志)执行
+            run_worker(self.sock, slot, self.counters)
+            sys.exit(0)
+        self.children[pid] = slot
+        return pid
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.children.pop(pid, None)
+            if slot is None:
+                continue
+            self.finished[pid] = self.counters[slot]
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            else:
+                print('Worker {} exited with status {}, starting a new one'.format(pid, status))
+
+    def stats(self):
+        workers = dict((str(pid), self.counters[slot]) for pid, slot in self.children.items())
+        finished = dict((str(pid), requests) for pid, requests in self.finished.items())
+        return {'workers': workers,
+                'finished': finished,
+                'total': sum(workers.values()) + sum(finished.values())}
+
+    def reload(self):
+        if self.retiring:
+            print('Still waiting for {} old workers to exit, not reloading'.format(len(self.retiring)))
+            return
+        old = list(self.children)
+        for _ in range(self.workers):
+            self.spawn()
+        # 新的 worker 已经能接连接了,旧的处理完手上的请求就退出
+        self.terminate(old)
+        print('Reloading: started {} new workers, stopping {}'.format(self.workers, len(old)))
+
+    def terminate(self, pids):
+        for pid in pids:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        self.terminate(list(self.children))
+        while self.children:
+            self.reap()
+            time.sleep(0.1)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        for _ in range(self.workers):
+            self.spawn()
+        while True:
+            time.sleep(0.5)
+            self.reap()
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGUSR1:
+                    print(json.dumps(self.stats()))
+            # 意外退出的 worker 补上
+            for _ in range(self.workers - len(self.children) + len(self.retiring)):
+                self.spawn()
+
+
+sock = listen(options.bind)
+if options.preload:
+    import app
+print('Listening on http://{}:{} with {} workers (pid {})'.format(
+    sock.getsockname()[0], sock.getsockname()[1], options.workers, os.getpid()))
+sys.stdout.flush()
+arbiter = Arbiter(sock, options.workers)
+arbiter.run()
+stats = arbiter.stats()
+print('Stopped, served {} requests'.format(stats['total']))
+if options.stats_file:
+    with open(options.stats_file, 'w') as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
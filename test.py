@@ -1,9 +1,55 @@
+import json
+import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+from contextlib import contextmanager
 from config import basedir
-from app import app, db
-from app.models import User, Post
-from datetime import datetime
+from flask import g
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+from app import app, archive, conditional, create_app, db, database, emails, identity, oid, profiling, ratelimit
+from app.models import User, Post, followers
+from app.cache import cache_stats, clear_caches, get_cache
+from app.counters import reconcile_counters
+from app.dataset import export_data, import_data
+from app.fragments import render_post
+from app.jobs import Job, Worker, job
+from app.lastseen import LastSeenTracker
+from app.logs import BatchingSMTPHandler, DropOldestQueue, JSONFormatter, LogQueueHandler
+from app.recommend import FollowGraph, recommender, who_to_follow
+from app.search import WhooshSearch, reindex, search
+from app.timeline import get_backend
+from datetime import datetime, timedelta
+
+
+@contextmanager
+def count_queries():
+    """
+    Record every SQL statement run inside the block; the list can be checked after the block ends
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+calls = []
+
+
+@job
+def flaky(n):
+    calls.append(n)
+    if len(calls) < 2:
+        raise IOError('try again')
 
 
 class TestCase(unittest.TestCase):
@@ -15,19 +61,49 @@ class TestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SEARCH_ENGINE'] = 'fts5'
+        # write last_seen in the request, so no background thread flushes it after tearDown
+        app.config['LAST_SEEN_WRITE_BEHIND'] = False
+        # jobs are run by the tests themselves through Worker.run_pending
+        app.config['JOB_WORKERS'] = 0
+        # build the follow graph for suggestions on first use instead of in a background thread
+        app.config['RECOMMEND_REBUILD_INTERVAL'] = 0
+        # the /stats endpoints are off by default; test_stats_disabled covers that
+        app.config['STATS_ENABLED'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
         self.app = app.test_client()
         db.create_all()
 
+    @contextmanager
+    def assertMaxQueries(self, n):
+        with count_queries() as statements:
+            yield statements
+        assert len(statements) <= n, '{} queries executed, expected at most {}:\n{}'.format(
+            len(statements), n, '\n'.join(statements))
+
     def tearDown(self):
         db.session.remove()
+        archive.metadata.drop_all(db.engine)
+        archive.refresh()
         db.drop_all()
+        recommender.reset()
+        ratelimit.reset()
+        clear_caches()
 
     def test_avatar(self):
         u = User(nickname='john', email='john@example.com')
         avatar = u.avatar(128)
         expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
         assert avatar[0:len(expected)] == expected
+        assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+        u.email = 'susan@example.com'
+        assert u.avatar(128) != avatar
+        local = app.config['AVATAR_LOCAL']
+        app.config['AVATAR_LOCAL'] = True
+        try:
+            assert u.avatar(50) == '/avatar/{}/50'.format(u.email_hash)
+        finally:
+            app.config['AVATAR_LOCAL'] = local
 
     def test_make_unique_nickname(self):
         u = User(nickname='john', email='john@example.com')
@@ -41,6 +117,27 @@ class TestCase(unittest.TestCase):
         nickname2 = User.make_unique_nickname('john')
         assert nickname2 != 'john'
         assert nickname2 != nickname
+        # one indexed query no matter how many collisions there are
+        start = 3
+        for n in (10, 100):
+            db.session.add_all(User(nickname='john{}'.format(i), email='john{}@example.com'.format(i))
+                               for i in range(start, n))
+            start = n
+            db.session.add(User(nickname='john0{}'.format(n), email='john0{}@example.com'.format(n)))
+            db.session.commit()
+            with self.assertMaxQueries(1):
+                assert User.make_unique_nickname('john') == 'john{}'.format(n)
+        # gaps are reused and other prefixes do not count
+        User.query.filter_by(nickname='john5').delete()
+        db.session.commit()
+        assert User.make_unique_nickname('john') == 'john5'
+        assert User.make_unique_nickname('jo') == 'jo'
+        assert User.register('john', 'john5@example.com').nickname == 'john5'
+        # a duplicate email is not retried with another nickname
+        with count_queries() as statements:
+            with self.assertRaises(IntegrityError):
+                User.register('john', 'john5@example.com')
+        assert len([statement for statement in statements if statement.startswith('INSERT')]) == 1
 
 
     def test_follow_posts(self):
@@ -92,5 +189,730 @@ class TestCase(unittest.TestCase):
         assert f3 == [p4, p3]
         assert f4 == [p4]
 
+    def test_timeline_fanout(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.add(u3)
+        db.session.commit()
+        utcnow = datetime.utcnow()
+        p1 = Post(body="old post from susan", author=u2, timestamp=utcnow)
+        db.session.add(p1)
+        db.session.commit()
+        # following backfills existing posts, new posts are pushed on flush
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body="new post from susan", author=u2, timestamp=utcnow + timedelta(seconds=1))
+        db.session.add(p2)
+        db.session.commit()
+        assert u1.followed_posts().all() == [p2, p1]
+        threshold, ttl = app.config['TIMELINE_FANOUT_THRESHOLD'], app.config['TIMELINE_CELEBRITY_TTL']
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        app.config['TIMELINE_CELEBRITY_TTL'] = 0
+        try:
+            # susan becomes a celebrity: her posts are merged at read time instead of fanned out
+            u3.follow(u2)
+            db.session.commit()
+            p3 = Post(body="post from famous susan", author=u2, timestamp=utcnow + timedelta(seconds=2))
+            db.session.add(p3)
+            db.session.commit()
+            assert (p2.fanned_out, p3.fanned_out) == (True, False)
+            assert u1.followed_posts().all() == [p3, p2, p1]
+            # back at the threshold the posts she made as a celebrity are still pulled
+            u3.unfollow(u2)
+            db.session.commit()
+            assert u1.followed_posts().all() == [p3, p2, p1]
+            assert u1.followed_posts_page(10).items == [p3, p2, p1]
+            p4 = Post(body="post from susan again", author=u2, timestamp=utcnow + timedelta(seconds=3))
+            db.session.add(p4)
+            db.session.commit()
+            assert p4.fanned_out
+            assert u1.followed_posts_page(10).items == [p4, p3, p2, p1]
+            # and above it again the fanned out posts stay in the timeline table
+            u3.follow(u2)
+            db.session.commit()
+            p5 = Post(body="post from famous susan again", author=u2, timestamp=utcnow + timedelta(seconds=4))
+            db.session.add(p5)
+            db.session.commit()
+            assert not p5.fanned_out
+            assert u1.followed_posts().all() == [p5, p4, p3, p2, p1]
+            assert u1.followed_posts_page(10).items == [p5, p4, p3, p2, p1]
+            # a rebuild without a threshold fans out everything
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = None
+            assert get_backend().rebuild() == 3
+            assert all(post.fanned_out for post in Post.query)
+            assert u1.followed_posts().all() == [p5, p4, p3, p2, p1]
+            u1.unfollow(u2)
+            db.session.commit()
+            assert u1.followed_posts().all() == []
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+            app.config['TIMELINE_CELEBRITY_TTL'] = ttl
+
+    def test_follow_cache(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        assert not u1.is_following(u2)
+        # a rolled back follow never reaches the cache
+        u1.follow(u2)
+        db.session.rollback()
+        assert not u1.is_following(u2)
+        # a committed follow is written through and invalidates the counts
+        db.session.add(u1.follow(u2))
+        db.session.commit()
+        assert get_cache('FOLLOW_CACHE').get('following:{}:{}'.format(u1.id, u2.id)) is True
+        assert u1.is_following(u2)
+        db.session.add(u1.unfollow(u2))
+        db.session.commit()
+        assert not u1.is_following(u2)
+        # another process follows behind the warm cache: follow() goes by the database, not the cache
+        db.session.execute(followers.insert().values(follower_id=u1.id, followed_id=u2.id))
+        db.session.commit()
+        assert not u1.is_following(u2)
+        assert u1.follow(u2) is None
+        db.session.commit()
+        assert (u1.followed.count(), u1.followed_count, u2.follower_count) == (1, 0, 0)
+        # and unfollows behind a cached True: no counter goes below the real count
+        db.session.execute(followers.delete())
+        db.session.commit()
+        get_cache('FOLLOW_CACHE').set('following:{}:{}'.format(u1.id, u2.id), True)
+        assert u1.unfollow(u2) is None
+        db.session.commit()
+        assert (u1.followed_count, u2.follower_count) == (0, 0)
+
+    def test_counters(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        assert (u1.follower_count, u1.followed_count, u1.post_count) == (0, 0, 0)
+        db.session.add(u1.follow(u2))
+        db.session.add(Post(body="post from susan", author=u2, timestamp=datetime.utcnow()))
+        db.session.commit()
+        assert (u1.followed_count, u2.follower_count, u2.post_count) == (1, 1, 1)
+        # break the counters behind the model's back and repair them
+        db.session.execute(User.__table__.update().values(follower_count=7, post_count=0))
+        db.session.commit()
+        assert reconcile_counters(batch_size=1) == 2
+        db.session.expire_all()
+        assert (u1.follower_count, u2.follower_count, u2.post_count) == (0, 1, 1)
+        assert reconcile_counters() == 0
+        db.session.add(u1.unfollow(u2))
+        db.session.commit()
+        assert (u1.followed_count, u2.follower_count) == (0, 0)
+        # two follows in one transaction both count, even with no autoflush in between
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        backend = app.config['TIMELINE_BACKEND']
+        app.config['TIMELINE_BACKEND'] = 'join'
+        try:
+            u1.follow(u2)
+            u1.follow(u3)
+            db.session.commit()
+        finally:
+            app.config['TIMELINE_BACKEND'] = backend
+        assert (u1.followed_count, u2.follower_count, u3.follower_count) == (2, 1, 1)
+
+    def test_last_seen_write_behind(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        tracker = LastSeenTracker(flush_size=1000, autostart=False)
+        utcnow = datetime.utcnow()
+        for i in range(10):
+            tracker.touch(u1.id, utcnow + timedelta(seconds=i))
+        tracker.touch(u2.id, utcnow)
+        assert User.query.get(u1.id).last_seen is None
+        assert tracker.flush() == 2
+        db.session.expire_all()
+        assert User.query.get(u1.id).last_seen == utcnow + timedelta(seconds=9)
+        assert User.query.get(u2.id).last_seen == utcnow
+        assert tracker.stats()['commits_saved'] == 10
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u1.id)
+        assert self.app.get('/stats/lastseen').json['commits_saved'] == 0
+
+    def test_stats_disabled(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        app.config['STATS_ENABLED'] = False
+        try:
+            for name in ('cache', 'requests', 'recommend', 'ratelimit', 'lastseen'):
+                assert self.app.get('/stats/' + name).status_code == 404
+        finally:
+            app.config['STATS_ENABLED'] = True
+
+    def test_cached_user_loader(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        db.session.add(u1.follow(u2))
+        db.session.commit()
+        # the first load reads the row, later loads are served from the snapshot
+        assert identity.load_user(u1.id).model is u1
+        cached = identity.load_user(u1.id)
+        assert cached._model is None
+        assert cached.nickname == 'john' and cached == u1
+        assert cached.avatar(128) == u1.avatar(128)
+        assert cached.is_following(u2) and cached.followed_count == 1
+        assert cached._model is None
+        # writes attach the ORM object, a profile change bumps the version
+        cached.nickname = 'johnny'
+        assert cached._model is u1
+        version = identity.profile_changed(cached)
+        db.session.commit()
+        assert version == 1
+        assert identity.load_user(u1.id, version).nickname == 'johnny'
+        # the old snapshot was dropped on commit
+        assert identity.load_user(u1.id, 0).nickname == 'johnny'
+
+    def test_search(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        p1 = Post(body="the avengers movie was so cool", author=u, timestamp=datetime.utcnow())
+        p2 = Post(body="beautiful day in portland", author=u, timestamp=datetime.utcnow())
+        db.session.add(p1)
+        db.session.add(p2)
+        db.session.commit()
+        # the index follows inserts, edits and deletes
+        assert search('portland').items == [p2]
+        p2.body = "beautiful day in seattle"
+        db.session.commit()
+        assert search('portland').items == []
+        assert search('seattle').items == [p2]
+        db.session.delete(p1)
+        db.session.commit()
+        assert search('avengers').total == 0
+        assert reindex(batch_size=1) == 1
+        assert search('seattle', per_page=1).items == [p2]
+        assert search('seattle', page=2, per_page=1).items == []
+        # authors are loaded with the hits
+        db.session.expunge_all()
+        with self.assertMaxQueries(4):
+            assert [post.author.nickname for post in search('seattle').items] == ['john']
+        # whoosh turns a page past the end into the last page; search returns an empty page instead
+        path = tempfile.mkdtemp()
+        try:
+            engine = WhooshSearch(path)
+            engine.update(None, {1: 'beautiful day'})
+            assert engine.search('beautiful', 1, 1) == ([1], 1)
+            assert engine.search('beautiful', 2, 1) == ([], 1)
+        finally:
+            shutil.rmtree(path)
+
+    def test_database_config(self):
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.session.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        # read-only views are routed to the replica, everything else stays on the primary
+        read_uri = app.config['SQLALCHEMY_READ_URI']
+        app.config['SQLALCHEMY_READ_URI'] = app.config['SQLALCHEMY_DATABASE_URI']
+        try:
+            with app.test_request_context('/'):
+                assert database.read_session() is db.session()
+                g.read_only = True
+                assert database.read_session() is not db.session()
+                assert database.read_query(User).filter_by(nickname='john').first().id == u.id
+                assert u.posts_page(10).items == []
+        finally:
+            app.config['SQLALCHEMY_READ_URI'] = read_uri
+
+    def test_eager_author_loading(self):
+        u = User(nickname='john', email='john@example.com')
+        authors = [User(nickname='author{}'.format(i), email='author{}@example.com'.format(i)) for i in range(5)]
+        db.session.add(u)
+        db.session.add_all(authors)
+        db.session.commit()
+        utcnow = datetime.utcnow()
+        for i, author in enumerate(authors):
+            db.session.add(u.follow(author))
+            db.session.add(Post(body="post #{}".format(i), author=author, timestamp=utcnow + timedelta(seconds=i)))
+        db.session.commit()
+        user_id, author_id = u.id, authors[0].id
+        # the fanout backend reads the timeline table and the posts it did not fan out
+        for loading, queries in (('lazy', 2 + len(authors)), ('selectin', 3), ('joined', 2)):
+            db.session.expunge_all()
+            u = User.query.get(user_id)
+            u.followed_posts_page(1)  # warm the timeline backend
+            with self.assertMaxQueries(queries):
+                page = u.followed_posts_page(10, loading=loading)
+                assert [post.author.nickname for post in page.items] == ['author4', 'author3', 'author2',
+                                                                         'author1', 'author0']
+            db.session.expunge_all()
+            u = User.query.get(user_id)
+            with self.assertMaxQueries(queries):
+                assert [post.author.nickname for post in u.followed_posts(loading=loading).all()][0] == 'author4'
+        db.session.expunge_all()
+        author = User.query.get(author_id)
+        with self.assertMaxQueries(1):
+            assert [post.author for post in author.posts_page(10).items] == [author]
+
+    def test_fragment_cache(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        p = Post(body="beautiful day in portland", author=u, timestamp=datetime.utcnow())
+        db.session.add(p)
+        db.session.commit()
+        with app.test_request_context('/'):
+            html = render_post(p)
+            assert 'john says: <b>beautiful day in portland</b>' in html
+            assert render_post(p) == html
+            assert cache_stats()['FRAGMENT_CACHE']['hits'] == 1
+            # the author's new nickname shows up once the profile version changes
+            u.nickname = 'johnny'
+            identity.profile_changed(u)
+            db.session.commit()
+            assert 'johnny says' in render_post(p)
+            # so does an edited post
+            p.body = "beautiful day in seattle"
+            db.session.commit()
+            assert 'seattle' in render_post(p)
+            assert cache_stats()['FRAGMENT_CACHE']['misses'] == 2
+
+    def test_keyset_pagination(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.follow(u)
+        utcnow = datetime.utcnow()
+        posts = [Post(body="post #{}".format(i), author=u, timestamp=utcnow + timedelta(seconds=i))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = posts[::-1]
+        for get_page in (u.posts_page, u.followed_posts_page):
+            page1 = get_page(2)
+            assert page1.items == newest_first[0:2]
+            assert not page1.has_prev and page1.has_next
+            page2 = get_page(2, after=page1.next_cursor)
+            assert page2.items == newest_first[2:4]
+            page3 = get_page(2, after=page2.next_cursor)
+            assert page3.items == newest_first[4:]
+            assert not page3.has_next and page3.has_prev
+            assert get_page(2, before=page3.prev_cursor).items == newest_first[2:4]
+            assert get_page(2, before=page2.prev_cursor).items == newest_first[0:2]
+            # a garbage cursor falls back to the first page
+            assert get_page(2, after='garbage').items == newest_first[0:2]
+
+    def test_conditional_get(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add(u1.follow(u2))
+        db.session.add(Post(body="hi from susan", author=u2, timestamp=datetime.utcnow()))
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u1.id)
+        for url in ('/index', '/user/susan'):
+            response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert response.status_code == 200
+            assert response.headers['Content-Encoding'] == 'gzip'
+            etag = response.headers['ETag']
+            assert etag.startswith('W/')
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304 and response.data == b''
+            # a new post changes both pages
+            db.session.add(Post(body="more from susan", author=u2, timestamp=datetime.utcnow()))
+            db.session.commit()
+            assert self.app.get(url, headers={'If-None-Match': etag}).status_code == 200
+        # the home page validators only need the cached snapshot, not the user row
+        identity.load_user(u1.id)
+        viewer = identity.load_user(u1.id)
+        conditional.timeline_validators(viewer)
+        assert viewer._model is None
+        # following someone changes the home page even without new posts
+        etag = self.app.get('/index').headers['ETag']
+        db.session.add(User(nickname='mary', email='mary@example.com'))
+        db.session.commit()
+        assert self.app.get('/follow/mary').status_code == 302
+        assert self.app.get('/index', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_bulk_follow(self):
+        u = User(nickname='john', email='john@example.com')
+        others = [User(nickname='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(5)]
+        db.session.add_all([u] + others)
+        db.session.commit()
+        db.session.add(Post(body="hi from user0", author=others[0], timestamp=datetime.utcnow()))
+        db.session.add(u.follow(others[0]))
+        db.session.commit()
+        # duplicates and existing rows are skipped, three statements per batch
+        ids = [o.id for o in others]
+        assert u.id
+        with self.assertMaxQueries(2 * 3 + 2):
+            result = u.follow_many(ids + [ids[1], 999], batch_size=3)
+        db.session.commit()
+        assert sorted(result.changed) == ids[1:]
+        assert [b['changed'] for b in result.to_dict()['batches']] == [2, 2]
+        assert u.followed_count == 5 and u.followed.count() == 5
+        assert others[3].follower_count == 1 and u.is_following(others[3])
+        result = u.unfollow_many([others[0], others[1]])
+        db.session.commit()
+        assert sorted(result.changed) == [others[0].id, others[1].id]
+        assert u.followed_count == 3 and not u.is_following(others[0])
+        assert others[0].follower_count == 0
+        assert u.followed_posts().count() == 0
+        # the import endpoint accepts JSON and CSV
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        response = self.app.post('/follow/import', json={'follow': ['user0', 'nobody'], 'unfollow': ['user4']})
+        assert response.get_json()['follow']['changed'] == 1
+        assert response.get_json()['not_found'] == ['nobody']
+        response = self.app.post('/follow/import', data='user1\nuser2,unfollow\n', content_type='text/csv')
+        assert response.get_json()['follow']['changed'] == 1
+        assert response.get_json()['unfollow']['changed'] == 1
+        assert self.app.post('/follow/import', data='user1', content_type='text/plain').status_code == 400
+        db.session.expire_all()
+        assert sorted(user.nickname for user in u.followed) == ['user0', 'user1', 'user3']
+
+    def test_job_queue(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        # follow returns before the mail is sent
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u1.id)
+        assert self.app.get('/follow/susan').status_code == 302
+        assert [j.name for j in Job.query.filter_by(status='queued')] == ['app.emails.follower_notification']
+        emails.mail.init_app(app)  # re-initialize with TESTING on so no mail is really sent
+        worker = Worker(retry_delay=60, max_attempts=2)
+        with emails.mail.record_messages() as outbox:
+            assert worker.run_pending() == 1
+        assert len(outbox) == 1 and outbox[0].recipients == ['susan@example.com']
+        assert 'john' in outbox[0].body and '/user/john' in outbox[0].html
+        # failures are retried with a backoff, and only after commit
+        del calls[:]
+        flaky.delay(1)
+        db.session.rollback()
+        assert worker.run_pending() == 0
+        item = flaky.delay(1)
+        db.session.commit()
+        assert worker.run_pending() == 1
+        db.session.refresh(item)
+        assert item.status == 'queued' and item.attempts == 1 and 'try again' in item.last_error
+        assert item.run_at > datetime.utcnow() + timedelta(seconds=50)
+        assert worker.run_pending() == 0
+        item.run_at = datetime.utcnow()
+        db.session.commit()
+        assert worker.run_pending() == 1
+        db.session.refresh(item)
+        assert item.status == 'done' and calls == [1, 1]
+        assert worker.stats()['retried'] == 1
+        # an idle poll only reads
+        with count_queries() as statements:
+            assert worker.run_pending() == 0
+        assert statements and all(statement.startswith('SELECT') for statement in statements)
+        # a job left running by a dead worker is claimed again once it times out
+        item = flaky.delay(2)
+        db.session.commit()
+        item.status, item.locked_at = 'running', datetime.utcnow() - timedelta(seconds=30)
+        db.session.commit()
+        assert worker.run_pending() == 0
+        worker.timeout = 10
+        assert worker.run_pending() == 1
+        db.session.refresh(item)
+        assert item.status == 'done' and calls == [1, 1, 2]
+
+    def test_log_pipeline(self):
+        # a full queue drops the oldest records instead of blocking
+        log_queue = DropOldestQueue(2)
+        handler = LogQueueHandler(log_queue)
+        logger = logging.getLogger('test_log_pipeline')
+        logger.propagate = False
+        logger.addHandler(handler)
+        for i in range(3):
+            logger.warning('record %d', i)
+        assert log_queue.dropped == 1
+        assert [log_queue.get_nowait().msg for i in range(2)] == ['record 1', 'record 2']
+        # exceptions are rendered in the request thread and survive JSON formatting
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('boom')
+        data = json.loads(JSONFormatter().format(log_queue.get_nowait()))
+        assert data['message'] == 'boom' and 'ZeroDivisionError' in data['exception']
+        logger.removeHandler(handler)
+
+        # error mails are batched: at most one per interval
+        sent = []
+
+        class RecordingSMTPHandler(BatchingSMTPHandler):
+            def send(self, records, skipped):
+                sent.append(([r.getMessage() for r in records], skipped))
+        mail_handler = RecordingSMTPHandler('localhost', 'from@example.com', ['to@example.com'], 'failure',
+                                            interval=3600, capacity=2)
+        for i in range(4):
+            mail_handler.handle(logging.makeLogRecord({'msg': 'error {}'.format(i)}))
+        assert sent == [(['error 0'], 0)]
+        mail_handler.close()
+        assert sent == [(['error 0'], 0), (['error 1', 'error 2'], 1)]
+
+    def test_profiling(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(u.follow(u))
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+        assert 'Server-Timing' not in self.app.get('/index').headers
+        app.config['PROFILING'] = True
+        app.config['PROFILING_SLOW_MS'] = 0
+        profiling.reset_stats()
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                response = self.app.get('/user/john')
+            timing = response.headers['Server-Timing']
+            assert timing.startswith('db;dur=') and 'tpl;dur=' in timing and 'total;dur=' in timing
+            # the slow request log points at the code that issued each statement
+            assert 'at app/views.py:' in logs.output[0]
+            stats = self.app.get('/stats/requests').get_json()
+            assert stats['/user/<nickname>']['requests'] == 1
+            assert stats['/user/<nickname>']['queries_per_request'] > 0
+            assert sum(stats['/user/<nickname>']['histogram'].values()) == 1
+        finally:
+            app.config['PROFILING'] = False
+
+    def test_export_import(self):
+        u1 = User(nickname='john', email='john@example.com', about_me='a "quoted", comma')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add(u1.follow(u2))
+        db.session.add(Post(body="hi,\nthere", author=u2, timestamp=datetime.utcnow()))
+        db.session.commit()
+        directory = tempfile.mkdtemp()
+        try:
+            for fmt in ('json', 'csv'):
+                assert export_data(os.path.join(directory, fmt), fmt, batch_size=1) == \
+                    {'user': 2, 'post': 1, 'followers': 1}
+            with self.assertRaises(ValueError):
+                import_data(os.path.join(directory, 'json'))
+            for fmt in ('json', 'csv'):
+                db.session.remove()
+                db.drop_all()
+                db.create_all()
+                assert import_data(os.path.join(directory, fmt), fmt, batch_size=1)['post'] == 1
+                john, susan = User.query.get(1), User.query.get(2)
+                assert john.about_me == 'a "quoted", comma' and susan.about_me is None
+                assert john.is_following(susan) and susan.follower_count == 1
+                assert susan.posts.first().body == "hi,\nthere"
+                assert isinstance(susan.posts.first().timestamp, datetime)
+                clear_caches()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_post_archive(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u1)
+        u1.follow(u2)
+        utcnow = datetime.utcnow()
+        # two recent posts and four spread over two months long ago
+        posts = [Post(body='new #{}'.format(i), author=u1 if i % 2 else u2,
+                      timestamp=utcnow - timedelta(minutes=i)) for i in range(2)]
+        posts += [Post(body='old #{}'.format(i), author=u1 if i % 2 else u2,
+                       timestamp=utcnow - timedelta(days=400 + 40 * (i // 2), minutes=i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        bodies = [p.body for p in posts]
+        ids = [p.id for p in posts]
+        reindex()
+        assert archive.archive_posts(horizon_days=200, batch_size=1) == 4
+        assert len(archive.months()) == 2 and Post.query.count() == 2
+        john = User.query.get(u1.id)
+        # the first page is filled from the hot tables without touching the archive
+        with count_queries() as statements:
+            assert [p.body for p in john.followed_posts_page(1).items] == bodies[:1]
+        assert not any(archive.PREFIX in statement for statement in statements)
+        for get_page, expected in ((john.followed_posts_page, bodies),
+                                   (john.posts_page, [b for i, b in enumerate(bodies) if i % 2])):
+            page = get_page(len(expected) // 3)
+            seen, pages = [p.body for p in page.items], [page]
+            while page.has_next:
+                page = get_page(len(expected) // 3, after=page.next_cursor)
+                seen += [p.body for p in page.items]
+                pages.append(page)
+            assert seen == expected
+            # page back from the last page
+            for i in range(len(pages) - 1, 0, -1):
+                assert get_page(len(expected) // 3, before=pages[i].prev_cursor).items == pages[i - 1].items
+        assert [p.author.nickname for p in john.followed_posts_page(10).items] == \
+            ['susan', 'john', 'susan', 'john', 'susan', 'john']
+        found = archive.find_posts(ids[2:])
+        assert sorted(p.body for p in found.values()) == sorted(bodies[2:])
+        assert sorted(p.body for p in search('old').items) == sorted(bodies[2:])
+        User.query.filter_by(id=u1.id).update({'post_count': 0})
+        db.session.commit()
+        reconcile_counters()
+        assert User.query.get(u1.id).post_count == 3
+        app.config['POST_ARCHIVE'] = False
+        try:
+            assert len(john.posts_page(10).items) == 1
+        finally:
+            app.config['POST_ARCHIVE'] = True
+
+    def test_who_to_follow(self):
+        users = [User(nickname=name, email='{}@example.com'.format(name))
+                 for name in ('john', 'susan', 'mary', 'david', 'kate')]
+        db.session.add_all(users)
+        db.session.commit()
+        john, susan, mary, david, kate = users
+        for u in users:
+            db.session.add(u.follow(u))
+        db.session.add(john.follow(susan))
+        db.session.add(john.follow(mary))
+        db.session.add(susan.follow(david))
+        db.session.add(mary.follow(david))
+        db.session.add(mary.follow(kate))
+        db.session.commit()
+        ids = dict((u.nickname, u.id) for u in users)
+        rebuilds = recommender.rebuilds
+        assert [(u.nickname, score) for u, score in who_to_follow(john)] == [('david', 2), ('kate', 1)]
+        graph = recommender.graph
+        assert graph.memory()['edges'] == 5 and recommender.rebuilds == rebuilds + 1
+        # committed changes update the graph in place without a rebuild
+        db.session.add(john.follow(david))
+        db.session.commit()
+        assert recommender.suggest(ids['john']) == [(ids['kate'], 1)]
+        john.unfollow_many([ids['mary']])
+        db.session.commit()
+        assert recommender.suggest(ids['john']) == []
+        john.follow_many([ids['mary']])
+        db.session.commit()
+        assert recommender.suggest(ids['john']) == [(ids['kate'], 1)]
+        # suggestions are counted on a snapshot that later changes do not touch
+        snapshot = graph.snapshot()
+        assert snapshot.added is graph.added
+        graph.apply(ids['john'], ids['kate'], True)
+        assert snapshot.suggest(ids['john'], 5) == [(ids['kate'], 1)]
+        assert graph.suggest(ids['john'], 5) == []
+        graph.apply(ids['john'], ids['kate'], False)
+        # uncommitted changes do not count
+        db.session.add(User.query.get(ids['susan']).follow(User.query.get(ids['kate'])))
+        db.session.rollback()
+        assert recommender.suggest(ids['susan']) == []
+        assert recommender.graph is graph and recommender.rebuilds == rebuilds + 1
+        # the same as a graph rebuilt from the database
+        rebuilt = FollowGraph.load()
+        for user_id in ids.values():
+            assert sorted(rebuilt.following(user_id)) == sorted(graph.following(user_id))
+        # an oversized delta drops the graph; the next request rebuilds it in its own context
+        max_delta = app.config['RECOMMEND_MAX_DELTA']
+        app.config['RECOMMEND_MAX_DELTA'] = 0
+        try:
+            john.unfollow_many([ids['mary']])
+            db.session.commit()
+            assert recommender.graph is None
+            john.follow_many([ids['mary']])
+            db.session.commit()
+        finally:
+            app.config['RECOMMEND_MAX_DELTA'] = max_delta
+        with self.app.session_transaction() as sess:
+            sess['_user_id'] = str(ids['john'])
+        for url in ('/index', '/user/susan'):
+            response = self.app.get(url)
+            assert b'Who to follow' in response.data and b'/follow/kate' in response.data
+        assert recommender.rebuilds == rebuilds + 2
+        assert self.app.get('/stats/recommend').json['users'] == 3
+
+    def test_lazy_extensions(self):
+        # importing app loads neither OpenID, mail nor forms, and attaches no log handlers
+        output = subprocess.check_output([sys.executable, '-c',
+                                          'import sys, app; '
+                                          'print([m for m in ("flask_openid", "flask_mail", "wtforms", "app.logs") '
+                                          'if m in sys.modules])'],
+                                         cwd=basedir)
+        assert output.decode('utf-8').strip() == '[]'
+        assert create_app() is app
+        # showing the login page does not need OpenID
+        response = self.app.get('/login')
+        assert response.status_code == 200 and b'openid' in response.data
+        assert not oid.loaded
+
+    def test_rate_limit(self):
+        users = [User(nickname=name, email='{}@example.com'.format(name)) for name in ('john', 'susan', 'mary')]
+        db.session.add_all(users)
+        db.session.commit()
+        app.config['RATELIMIT_FOLLOW'] = '2/minute'
+        try:
+            with self.app.session_transaction() as sess:
+                sess['_user_id'] = str(users[0].id)
+            assert self.app.get('/follow/susan').status_code == 302
+            assert self.app.get('/unfollow/susan').status_code == 302
+            # the bucket is empty: 429 without a single SQL statement
+            with count_queries() as statements:
+                response = self.app.get('/follow/mary')
+            assert response.status_code == 429 and statements == []
+            assert 0 < int(response.headers['Retry-After']) <= 30
+            assert not User.query.get(users[0].id).is_following(User.query.get(users[2].id))
+            # another user from the same IP hits the empty IP bucket
+            with self.app.session_transaction() as sess:
+                sess['_user_id'] = str(users[1].id)
+            assert self.app.get('/follow/mary').status_code == 429
+            # another user on another IP is not affected
+            response = self.app.get('/follow/mary', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            assert response.status_code == 302
+            assert ratelimit.stats()['rejected'] == 2 and ratelimit.stats()['allowed'] == 3
+        finally:
+            app.config['RATELIMIT_FOLLOW'] = '30/minute'
+        # tokens refill over time and a rejected request takes none
+        store = ratelimit.BucketStore(max_keys=2)
+        bucket = [('k', 2, 1.0)]
+        assert [store.take(bucket, now=100.0)[0] for _ in range(3)] == [True, True, False]
+        assert store.take(bucket + [('other', 1, 1.0)], now=100.5) == (False, 0.5)
+        assert store.take([('other', 1, 1.0)], now=100.5) == (True, 0.0)
+        assert store.take(bucket, now=101.0)[0] and len(store) == 2
+        directory = tempfile.mkdtemp()
+        try:
+            shared = ratelimit.SharedBucketStore(os.path.join(directory, 'buckets'))
+            assert shared.take(bucket, now=100.0)[0] and shared.take(bucket, now=100.0)[0]
+            other_process = ratelimit.SharedBucketStore(os.path.join(directory, 'buckets'))
+            assert not other_process.take(bucket, now=100.0)[0]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_after_fork(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        # the parent's pool already holds a connection; the child gets a pool of its own
+        assert User.query.count() == 1
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                database.after_fork(app, db)
+                db.session.remove()
+                db.session.add(User(nickname='susan', email='susan@example.com'))
+                db.session.commit()
+                code = 0 if User.query.count() == 2 else 1
+            finally:
+                os._exit(code)
+        assert os.waitpid(pid, 0)[1] == 0
+        db.session.remove()
+        assert sorted(u.nickname for u in User.query) == ['john', 'susan']
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+import argparse
+import time
+from app import create_app
+from app.jobs import workers
+
+"""
+单独跑后台任务的 worker 进程,见 app/jobs.py。
+可以和 web 进程里的 worker 线程(JOB_WORKERS)同时跑,也可以把 JOB_WORKERS 设成 0 只用这个。
+
+    python worker.py --threads 4
+    python worker.py --burst        把队列里到期的任务做完就退出
+"""
+app = create_app()
+parser = argparse.ArgumentParser(description='Run background job workers.')
+parser.add_argument('--threads', type=int, default=app.config['JOB_WORKERS'] or 1)
+parser.add_argument('--burst', action='store_true', help='run the due jobs and exit')
+options = parser.parse_args()
+
+if options.burst:
+    with app.app_context():
+        count = workers.run_pending()
+    print('Ran', count, 'jobs:', workers.stats())
+else:
+    workers.start(options.threads)
+    print('Started', options.threads, 'job worker threads, press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        workers.stop()
+        print('Stopped:', workers.stats())